@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+"""
+End-to-end benchmark of the scripts which doesn't need network access.
+
+The forges are replaced by fake_forge (with a latency and transient errors),
+dist-git repositories are generated locally with spec files of varying size
+and git is pointed to them instead of git.centos.org. Dist2Src, the SRPM
+creation and mock are stubbed, everything else (listing, cloning, caches,
+pushing) is the real code. Dependencies of the scripts have to be installed.
+
+    ./bench_offline.py --packages 100 --output bench.json
+    ./bench_offline.py --packages 100 --baseline bench.json
+
+With --baseline, the run fails if a scenario is slower than in the baseline
+by more than --tolerance.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, List
+
+import git
+
+from fake_forge import FakeForgeServer, FakeGitService
+
+root = Path(__file__).resolve().parent.parent
+for scripts_dir in ("pkg_survey", "onboard", "master-branches"):
+    sys.path.insert(0, str(root / scripts_dir))
+
+FAKE_MOCK = """#!/bin/sh
+for arg; do case $arg in --resultdir=*) resultdir=${arg#--resultdir=};; esac; done
+echo "offline benchmark build" > "$resultdir/build.log"
+"""
+# digest of the whole file, instead of the NEVR and file digests from its header
+FAKE_RPM = """#!/bin/sh
+for arg; do srpm=$arg; done
+sha256sum "$srpm"
+"""
+
+
+def generate_spec(name: str, rng: random.Random, max_lines: int) -> str:
+    patches = rng.randint(0, 30)
+    lines = [
+        f"Name: {name}",
+        "Version: 1.0",
+        "Release: 1%{?dist}",
+        "Summary: Package generated by the offline benchmark",
+        "License: MIT",
+        f"Source0: {name}-1.0.tar.gz",
+    ]
+    lines += [f"Patch{i}: {name}-{i}.patch" for i in range(patches)]
+    lines += ["", "%description", "Generated.", "", "%prep"]
+    if rng.random() < 0.5:
+        lines.append("%autosetup -p1")
+    else:
+        lines.append("%setup -q")
+        for i in range(patches):
+            if rng.random() < 0.1:
+                lines += ["%if 0%{?rhel}", f"%patch{i} -p1", "%endif"]
+            else:
+                lines.append(f"%patch{i} -p1")
+    lines += ["", "%build", "%make_build", "", "%install", "%make_install", ""]
+    lines += ["%files", f"%{{_bindir}}/{name}", "", "%changelog"]
+    while len(lines) < rng.randint(50, max_lines):
+        lines += [
+            "* Mon Jan 01 2024 Packager <packager@example.com> - 1.0-1",
+            f"- Change number {len(lines)}",
+            "",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def create_distgit_repo(path: Path, name: str, spec: str):
+    repo = git.Repo.init(path)
+    repo.git.symbolic_ref("HEAD", "refs/heads/c8s")
+    (path / "SPECS").mkdir()
+    (path / "SPECS" / f"{name}.spec").write_text(spec)
+    (path / f".{name}.metadata").write_text(
+        f"0123456789abcdef SOURCES/{name}-1.0.tar.gz\n"
+    )
+    repo.git.add("--all")
+    repo.git.commit("-m", f"import {name}-1.0-1")
+
+
+def create_sandbox(sandbox: Path, packages: List[str], max_lines: int, seed: int):
+    """dist-git repos, fake mock and rpm and the git configuration pointing to them"""
+    # git reads the configuration from $HOME, a global one would be shared with the user
+    home = sandbox / "home"
+    home.mkdir()
+    (home / ".gitconfig").write_text(
+        "[user]\n"
+        "    name = Offline Benchmark\n"
+        "    email = benchmark@localhost\n"
+        f'[url "file://{sandbox}/git/"]\n'
+        "    insteadOf = https://git.centos.org/\n"
+        "    insteadOf = https://git.stg.centos.org/\n"
+    )
+    os.environ["HOME"] = str(home)
+    rng = random.Random(seed)
+    for name in packages:
+        create_distgit_repo(
+            sandbox / "git" / "rpms" / name, name, generate_spec(name, rng, max_lines)
+        )
+    (sandbox / "git" / "source-git").mkdir(parents=True)
+    bin_dir = sandbox / "bin"
+    bin_dir.mkdir()
+    for tool, script in (("mock", FAKE_MOCK), ("rpm", FAKE_RPM)):
+        (bin_dir / tool).write_text(script)
+        (bin_dir / tool).chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}:{os.environ['PATH']}"
+
+
+class FakeDist2Src:
+    """commits the spec file of the dist-git repo to the source-git repo"""
+
+    def __init__(self, dist_git_path: Path, source_git_path: Path):
+        self.dist_git_path = dist_git_path
+        self.source_git_path = source_git_path
+
+    def convert(self, origin_branch: str, dest_branch: str):
+        if (self.source_git_path / ".git").is_dir():
+            repo = git.Repo(self.source_git_path)
+        else:
+            repo = git.Repo.init(self.source_git_path)
+            repo.git.symbolic_ref("HEAD", f"refs/heads/{dest_branch}")
+        (self.source_git_path / "SPECS").mkdir(exist_ok=True)
+        for spec in (self.dist_git_path / "SPECS").iterdir():
+            shutil.copy(spec, self.source_git_path / "SPECS" / spec.name)
+        repo.git.add("--all")
+        repo.git.commit("--allow-empty", "-m", f"Convert {origin_branch}")
+        repo.git.tag("-f", "sg-start")
+
+
+class FakePackitAPI:
+    """an SRPM is a tarball of the spec file"""
+
+    def __init__(self, project_path: Path):
+        self.path = Path(project_path)
+
+    def create_srpm(self, srpm_dir: Path) -> str:
+        srpm_path = Path(srpm_dir) / f"{self.path.name}-1.0-1.src.rpm"
+        with tarfile.open(srpm_path, "w:gz") as srpm:
+            srpm.add(str(self.path / "SPECS"), arcname="SPECS")
+        return str(srpm_path)
+
+
+def import_scripts(sandbox: Path) -> Dict[str, ModuleType]:
+    """import the scripts, configured by env vars, and stub what can't run offline"""
+    os.environ["CACHE_DIR"] = str(sandbox / "cache")
+    import add_master_branch
+    import conversion_cache
+    import onboard
+    import survey
+
+    spec = importlib.util.spec_from_file_location("list_repos", root / "list-repos.py")
+    list_repos = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(list_repos)
+
+    survey.workspaces = sys.modules["workspaces"].Workspaces(
+        sandbox / "playground" / "workspaces", max_size=10 * 1024**3
+    )
+    survey.dist2src = FakeDist2Src
+    # a key of cached conversions, dist2src doesn't have to be installed
+    conversion_cache.distribution_version = lambda _: "bench"  # type: ignore[assignment]
+    survey.packit_api = FakePackitAPI
+    service = FakeGitService(sandbox / "git")
+    # replaces the lru_cache wrapper, which is only about not creating the client twice
+    add_master_branch.get_service = lambda: service  # type: ignore[assignment]
+    add_master_branch.AddMasterBranch.scratch_repo = sandbox / "master-branch.git"
+    return {
+        "survey": survey,
+        "onboard": onboard,
+        "add_master_branch": add_master_branch,
+        "list_repos": list_repos,
+    }
+
+
+class Benchmark:
+    def __init__(self, sandbox: Path, forge: FakeForgeServer, workers: int):
+        self.sandbox = sandbox
+        self.forge = forge
+        self.workers = workers
+        self.modules = import_scripts(sandbox)
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+    def clean(self):
+        """forget the source-git repos and all the caches"""
+        self.modules["survey"].workspaces.wait()
+        for path in (
+            self.sandbox / "git" / "source-git",
+            self.sandbox / "cache",
+            self.sandbox / "playground",
+        ):
+            shutil.rmtree(path, ignore_errors=True)
+        (self.sandbox / "git" / "source-git").mkdir(parents=True)
+
+    def measure(self, scenario: str, run: Callable[[], int]):
+        requests_before = self.forge.requests
+        start = time.monotonic()
+        items = run()
+        seconds = time.monotonic() - start
+        self.results[scenario] = {
+            "items": items,
+            "seconds": round(seconds, 3),
+            "per_second": round(items / seconds, 3),
+            "requests": self.forge.requests - requests_before,
+        }
+        print(
+            f"{scenario:<24} {items:>6} items {seconds:>8.2f}s "
+            f"{items / seconds:>8.2f}/s {self.results[scenario]['requests']:>6} requests"
+        )
+
+    def gitlab_scan(self, workers: int) -> int:
+        import gitlab
+
+        # loaded from a file, attributes of which mypy doesn't know
+        list_repos: Any = self.modules["list_repos"]
+        client = gitlab.Gitlab(
+            url=self.forge.url,
+            session=list_repos.RateLimitedSession(0),
+            retry_transient_errors=True,
+        )
+        list_repos.gitlab_client = lambda: client
+        group = client.groups.get(id=list_repos.src_group_id)
+        journal = list_repos.JsonLinesJournal(self.sandbox / "packages.journal", 50)
+        c8s_projects: Dict[str, List[str]] = {}
+        c9s_projects: Dict[str, List[str]] = {}
+        last_activity: Dict[str, str] = {}
+        # the script prints every project
+        with contextlib.redirect_stdout(io.StringIO()):
+            if workers > 1:
+                list_repos.collect_projects_concurrently(
+                    c8s_projects, c9s_projects, last_activity, group, journal, workers
+                )
+            else:
+                list_repos.collect_projects(
+                    c8s_projects, c9s_projects, last_activity, group, journal
+                )
+        journal.remove()
+        return len(last_activity)
+
+    def survey(self, workers: int) -> int:
+        survey = self.modules["survey"]
+        sink_path = self.sandbox / "result-data.jsonl"
+        if sink_path.exists():
+            sink_path.unlink()
+        sink = sys.modules["result_sink"].ResultSink(sink_path)
+        survey.fetch_centos_pkgs_info(
+            f"{self.forge.url}/api/0/projects?namespace=rpms", sink, workers=workers
+        )
+        return len(sink.records())
+
+    def survey_queue(self, workers: int) -> int:
+        """worker processes of a multi-host survey, sharing a work queue"""
+        survey = self.modules["survey"]
+        queue_path = self.sandbox / "work-queue.sqlite"
+        if queue_path.exists():
+            queue_path.unlink()
+        queue = sys.modules["work_queue"].WorkQueue(queue_path)
+        survey.survey_queue(
+            queue, f"{self.forge.url}/api/0/projects?namespace=rpms", workers=workers
+        )
+        return len(queue.results())
+
+    def onboarding(self, pipeline: bool) -> int:
+        onboard = self.modules["onboard"]
+        sink = sys.modules["result_sink"].ResultSink(self.sandbox / "result.jsonl")
+        ocp = onboard.OnboardCentosPKG(
+            service=FakeGitService(self.sandbox / "git"),
+            namespace="source-git",
+            maintainers=[],
+            maintainers_group=[],
+            update=False,
+            result_sink=sink,
+            metadata_cache=sys.modules["metadata_cache"].MetadataCache(
+                self.sandbox / "metadata.json", ttl=0
+            ),
+        )
+        jobs = [onboard.PackageJob(name, "c8s", False) for name in self.forge.packages]
+        if pipeline:
+            ocp.run_pipeline(jobs)
+        else:
+            for job in jobs:
+                ocp.run_job(job)
+        return len(jobs)
+
+    def master_branches(self) -> int:
+        add_master_branch = self.modules["add_master_branch"]
+        projects = add_master_branch.iterate_projects(
+            f"{self.forge.url}/api/0/projects?namespace=source-git"
+        )
+        # projects whose onboarding was aborted don't exist, only successes count
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return sum(executor.map(add_master_branch.add_master_branch, projects))
+
+    def run(self):
+        self.measure("gitlab_scan", lambda: self.gitlab_scan(1))
+        self.measure("gitlab_scan_concurrent", lambda: self.gitlab_scan(self.workers))
+        self.clean()
+        self.measure("survey_cold", lambda: self.survey(1))
+        self.measure("survey_warm", lambda: self.survey(1))
+        self.clean()
+        self.measure("survey_parallel_cold", lambda: self.survey(self.workers))
+        self.clean()
+        self.measure("survey_queue_cold", lambda: self.survey_queue(1))
+        self.clean()
+        self.measure(
+            "survey_queue_workers_cold", lambda: self.survey_queue(self.workers)
+        )
+        self.clean()
+        self.measure("onboard_cold", lambda: self.onboarding(pipeline=False))
+        self.clean()
+        self.measure("onboard_pipeline_cold", lambda: self.onboarding(pipeline=True))
+        self.measure("master_branches", self.master_branches)
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> bool:
+    """False if a scenario got slower than the baseline by more than tolerance"""
+    ok = True
+    for scenario, result in results["scenarios"].items():
+        if scenario not in baseline["scenarios"]:
+            continue
+        before = baseline["scenarios"][scenario]["per_second"]
+        change = result["per_second"] / before - 1
+        regression = change < -tolerance
+        ok = ok and not regression
+        print(
+            f"{scenario:<24} {before:>8.2f}/s -> {result['per_second']:>8.2f}/s "
+            f"{change:>+7.1%}{'  REGRESSION' if regression else ''}"
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--packages", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--max-spec-lines", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results there")
+    parser.add_argument("--baseline", type=Path, help="results to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    packages = [f"bench-{i:05}" for i in range(args.packages)]
+    forge = FakeForgeServer(packages, args.latency, args.error_rate, args.seed)
+    forge.start()
+    sandbox = Path(tempfile.mkdtemp(prefix="offline-bench-"))
+    try:
+        create_sandbox(sandbox, packages, args.max_spec_lines, args.seed)
+        benchmark = Benchmark(sandbox, forge, args.workers)
+        # the scripts log every step of every package
+        logging.getLogger().setLevel(logging.WARNING)
+        benchmark.run()
+    finally:
+        forge.stop()
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    results = {
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        "scenarios": benchmark.results,
+        "errors_injected": forge.errors,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, default=str))
+    if args.baseline and not compare(
+        results, json.loads(args.baseline.read_text()), args.tolerance
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
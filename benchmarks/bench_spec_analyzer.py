@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Micro-benchmark of the spec file analysis done by the survey.
+
+Compares the single-pass analyzer with the regex scans it replaced
+on spec files found in the provided directories (or the files themselves),
+by default on spec files of all the branches of the dist-git mirrors
+the survey keeps in CACHE_DIR/mirrors:
+
+    ./bench_spec_analyzer.py [PATH ...]
+"""
+import os
+import re
+import subprocess
+import sys
+import timeit
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "pkg_survey"))
+
+from spec_analyzer import analyze_spec  # noqa: E402
+
+
+def regex_scan(spec_cont: str):
+    """the analysis survey.py used to do"""
+    conditions = re.findall(r"\n%if.*?\n%endif", spec_cont, re.DOTALL)
+    result = []
+    p = re.compile("\n%if (.*)\n")
+    for con in conditions:
+        if "\n%patch" in con:
+            found = p.search(con)
+            if found:
+                result.append(found.group(1))
+    return {
+        "autosetup": bool(re.search(r"\n%autosetup", spec_cont)),
+        "setup": bool(re.search(r"\n%setup", spec_cont)),
+        "conditional_patch": result,
+    }
+
+
+def find_specs(paths: List[str]) -> List[Path]:
+    specs: List[Path] = []
+    for path in map(Path, paths):
+        specs.extend([path] if path.is_file() else sorted(path.rglob("*.spec")))
+    return specs
+
+
+def mirror_specs(mirrors_dir: Path) -> List[str]:
+    """spec files on the branches of the mirrors, every version of a spec file once"""
+
+    def git(mirror: Path, *args: str) -> str:
+        return subprocess.run(
+            ["git", "-C", str(mirror), *args],
+            check=True,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+        ).stdout
+
+    specs: List[str] = []
+    for mirror in sorted(mirrors_dir.glob("*.git")):
+        blobs = set()
+        branches = git(mirror, "for-each-ref", "--format=%(refname)", "refs/heads")
+        for branch in branches.split():
+            for line in git(mirror, "ls-tree", "-r", branch).splitlines():
+                meta, path = line.split("\t", 1)
+                if path.endswith(".spec"):
+                    blobs.add(meta.split()[2])
+        specs.extend(git(mirror, "cat-file", "blob", blob) for blob in sorted(blobs))
+    return specs
+
+
+def main(paths: List[str], repeat: int = 5):
+    if paths:
+        specs = [spec.read_text(errors="replace") for spec in find_specs(paths)]
+    else:
+        cache_dir = Path(os.getenv("CACHE_DIR", "/tmp/playground/cache"))
+        paths = [str(cache_dir / "mirrors")]
+        specs = mirror_specs(cache_dir / "mirrors")
+    if not specs:
+        print(f"No spec files found in {paths}")
+        sys.exit(1)
+    size = sum(len(spec) for spec in specs)
+    print(f"{len(specs)} spec files, {size / 1024:.0f} KiB")
+
+    def run_regex():
+        for spec in specs:
+            regex_scan(spec)
+
+    def run_analyzer():
+        for spec in specs:
+            analyze_spec(spec)
+
+    for name, func in (("regex", run_regex), ("analyzer", run_analyzer)):
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(
+            f"{name:>10}: {best * 1000:8.1f} ms total, "
+            f"{best / len(specs) * 1e6:8.1f} us per spec, "
+            f"{size / best / 1024**2:6.1f} MiB/s"
+        )
+
+    differ = sum(
+        regex_scan(spec)["conditional_patch"] != analyze_spec(spec)["conditional_patch"]
+        for spec in specs
+    )
+    print(f"conditional_patch differs for {differ} spec files")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
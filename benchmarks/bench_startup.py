@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+Startup time of the cli.py subcommands.
+
+Every command is run `--repeat` times in a fresh interpreter, the median
+is compared with the startup of a bare interpreter. Commands which don't
+do any work (displaying packages.json, a trivial query) and imports
+of the tools the way cli.py does it, without running them, show how much
+importing the tools and creating the clients costs. --help of a command
+returns before its tool is imported.
+
+    ./bench_startup.py --repeat 10
+    ./bench_startup.py --output startup.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+root = Path(__file__).resolve().parent.parent
+cli = str(root / "cli.py")
+
+
+def import_tool(module: str) -> List[str]:
+    """what a command of cli.py costs before the tool starts working"""
+    return [sys.executable, "-c", f"import cli, {module}"]
+
+
+COMMANDS: Dict[str, List[str]] = {
+    "python": [sys.executable, "-c", "pass"],
+    "help": [sys.executable, cli, "--help"],
+    "list-repos --cached": [sys.executable, cli, "list-repos", "--cached"],
+    "import list-repos": [sys.executable, "-c", "import cli; cli.list_repos()"],
+    "import survey": import_tool("survey"),
+    "import onboard": import_tool("onboard"),
+    "import add-master-branch": import_tool("add_master_branch"),
+    "query sql": [sys.executable, cli, "query", "sql", "SELECT 1"],
+}
+
+
+def run(command: List[str]) -> float:
+    start = time.monotonic()
+    subprocess.run(
+        command,
+        cwd=root,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, command in COMMANDS.items():
+        # the first run warms up the page cache and writes .pyc files
+        run(command)
+        times = [run(command) for _ in range(args.repeat)]
+        results[name] = {
+            "median": round(statistics.median(times), 4),
+            "min": round(min(times), 4),
+        }
+    baseline = results["python"]["median"]
+    print(f"{'command':<26} {'median [ms]':>11} {'min [ms]':>9} {'over python':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:<26} {result['median'] * 1000:>11.0f} {result['min'] * 1000:>9.0f} "
+            f"{(result['median'] - baseline) * 1000:>+12.0f}"
+        )
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Local stand-ins of the forges the scripts talk to, for the offline benchmarks.
+
+FakeForgeServer serves the parts of the Pagure and GitLab APIs the scripts use
+from a list of package names, with a configurable latency and rate of transient
+errors. FakeGitService is an in-process replacement of the ogr services, its
+projects are bare git repositories in a local directory.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import git
+
+
+class FakeForgeServer:
+    """
+    Pagure: GET /api/0/projects (paginated)
+    GitLab: GET /api/v4/groups/<id>, /api/v4/groups/<id>/projects (paginated),
+            /api/v4/projects/<id>, /api/v4/projects/<id>/repository/branches
+
+    Every project has c8s, every third one c9s as well. Requests are answered
+    after `latency` seconds, `error_rate` of them with 503.
+    """
+
+    def __init__(
+        self,
+        packages: List[str],
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.packages = packages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def branches(self, index: int) -> List[str]:
+        return ["c8s"] + (["c9s"] if index % 3 == 0 else [])
+
+    def page(self, query: Dict[str, List[str]]) -> Tuple[int, int, List[int]]:
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["20"])[0])
+        start = (page - 1) * per_page
+        return (
+            page,
+            per_page,
+            list(range(start, min(start + per_page, len(self.packages)))),
+        )
+
+    def respond(self, path: str, query: Dict[str, List[str]]) -> Optional[Any]:
+        """body of the response, None if there's no such endpoint"""
+        if path == "/api/0/projects":
+            page, per_page, indexes = self.page(query)
+            next_page = None
+            if indexes and indexes[-1] + 1 < len(self.packages):
+                params = {key: values[0] for key, values in query.items()}
+                params.update(page=str(page + 1), per_page=str(per_page))
+                next_page = f"{self.url}{path}?{urlencode(params)}"
+            return {
+                "projects": [{"name": self.packages[i]} for i in indexes],
+                "pagination": {"next": next_page},
+            }
+        if re.fullmatch(r"/api/v4/groups/\d+", path):
+            return {"id": int(path.rsplit("/", 1)[1]), "name": "src", "path": "src"}
+        if re.fullmatch(r"/api/v4/groups/\d+/projects", path):
+            return [
+                {
+                    "id": i,
+                    "name": self.packages[i],
+                    "last_activity_at": "2022-01-01T00:00:00.000Z",
+                }
+                for i in self.page(query)[2]
+            ]
+        match = re.fullmatch(r"/api/v4/projects/(\d+)(/repository/branches)?", path)
+        if match and int(match.group(1)) < len(self.packages):
+            index = int(match.group(1))
+            if match.group(2):
+                return [{"name": branch} for branch in self.branches(index)]
+            return {"id": index, "name": self.packages[index]}
+        return None
+
+    def start(self):
+        forge = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status: int, body: bytes = b""):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(forge.latency)
+                with forge.lock:
+                    forge.requests += 1
+                    failed = forge.random.random() < forge.error_rate
+                    forge.errors += failed
+                if failed:
+                    self.send(503)
+                    return
+                url = urlparse(self.path)
+                body = forge.respond(url.path, parse_qs(url.query))
+                if body is None:
+                    self.send(404, b'{"message": "404 Not found"}')
+                else:
+                    self.send(200, json.dumps(body).encode())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeGitProject:
+    def __init__(self, repos_dir: Path, namespace: str, repo: str):
+        self.path = repos_dir / namespace / repo
+
+    def exists(self) -> bool:
+        return (self.path / "HEAD").is_file()
+
+    def get_branches(self) -> List[str]:
+        # ogr fails the same way, git would list the branches of the current directory
+        if not self.exists():
+            raise FileNotFoundError(f"No such project: {self.path}")
+        refs = git.Git(self.path).for_each_ref(
+            "--format=%(refname:short)", "refs/heads"
+        )
+        return refs.split()
+
+    def get_git_urls(self) -> Dict[str, str]:
+        return {"git": str(self.path), "ssh": str(self.path)}
+
+    def get_web_url(self) -> str:
+        return f"file://{self.path}"
+
+
+class FakeGitService:
+    """the subset of ogr's GitService used by the onboarding and the master branches"""
+
+    instance_url = "file://"
+
+    def __init__(self, repos_dir: Path):
+        self.repos_dir = repos_dir
+
+    def get_project(self, namespace: str, repo: str) -> FakeGitProject:
+        return FakeGitProject(self.repos_dir, namespace, repo)
+
+    def project_create(
+        self, repo: str, namespace: str, description: str = ""
+    ) -> FakeGitProject:
+        project = self.get_project(namespace, repo)
+        git.Repo.init(project.path, bare=True)
+        return project
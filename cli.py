@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""
+Single entry point of the tools in this repo.
+
+A tool (and whatever it depends on) is imported only when its command runs,
+clients of the forges are created on their first use, so e.g. displaying
+packages.json or querying results doesn't wait for python-gitlab, ogr,
+packit or dist2src to be imported.
+
+    ./cli.py list-repos [--cached]
+    ./cli.py survey [PACKAGE ...]
+    ./cli.py onboard [PACKAGE[:BRANCH] ...]
+    ./cli.py add-master-branch [PACKAGE ...]
+    ./cli.py query packages --stream c9 --error-class ConvertError
+    ./cli.py queue status /shared/work-queue.sqlite
+"""
+import argparse
+import importlib.util
+import sys
+from pathlib import Path
+from types import ModuleType
+
+root = Path(__file__).resolve().parent
+# in the container, all the modules are next to this script
+for tools_dir in ("pkg_survey", "onboard", "master-branches"):
+    sys.path.insert(0, str(root / tools_dir))
+
+
+def list_repos() -> ModuleType:
+    """list-repos.py is not a valid module name"""
+    spec = importlib.util.spec_from_file_location("list_repos", root / "list-repos.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_list_repos(args: argparse.Namespace):
+    if args.cached:
+        list_repos().show_packages()
+    else:
+        list_repos().main()
+
+
+def run_survey(args: argparse.Namespace):
+    import survey
+
+    survey.main(args.packages)
+
+
+def run_onboard(args: argparse.Namespace):
+    import onboard
+
+    onboard.main(args.packages)
+
+
+def run_add_master_branch(args: argparse.Namespace):
+    import add_master_branch
+
+    add_master_branch.main(args.packages)
+
+
+def run_query(args: argparse.Namespace):
+    import results_db
+
+    results_db.main(args.passed_args)
+
+
+def run_queue(args: argparse.Namespace):
+    import work_queue
+
+    work_queue.main(args.passed_args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser(
+        "list-repos", help="scan source-git projects on gitlab.com to packages.json"
+    )
+    command.add_argument(
+        "--cached", action="store_true", help="only display packages.json"
+    )
+    command.set_defaults(run=run_list_repos)
+
+    command = commands.add_parser("survey", help="try to convert dist-git packages")
+    command.add_argument("packages", nargs="*", help="all packages by default")
+    command.set_defaults(run=run_survey)
+
+    command = commands.add_parser("onboard", help="onboard packages to source-git")
+    command.add_argument(
+        "packages",
+        nargs="*",
+        metavar="package[:branch]",
+        help="packages of /in/input-pkgs.yml (/in/update-pkgs.yml) by default",
+    )
+    command.set_defaults(run=run_onboard)
+
+    command = commands.add_parser(
+        "add-master-branch", help="add master branch to source-git projects"
+    )
+    command.add_argument("packages", nargs="*", help="all projects by default")
+    command.set_defaults(run=run_add_master_branch)
+
+    # all the arguments of these are passed to the tool, including --help
+    command = commands.add_parser(
+        "query", help="query result files, see query --help", add_help=False
+    )
+    command.set_defaults(run=run_query)
+    command = commands.add_parser(
+        "queue",
+        help="status and results of a multi-host run, see queue --help",
+        add_help=False,
+    )
+    command.set_defaults(run=run_queue)
+
+    args, passed_args = parser.parse_known_args()
+    if passed_args and args.run not in (run_query, run_queue):
+        parser.error(f"unrecognized arguments: {' '.join(passed_args)}")
+    args.passed_args = passed_args
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
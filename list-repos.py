@@ -6,13 +6,46 @@ Gitlab token is picked from an env var GITLAB_TOKEN, make sure to set it.
 """
 import json
 import os
+import sys
+import threading
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    Future,
+    wait,
+    as_completed,
+    FIRST_COMPLETED,
+)
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, List, Tuple, Dict
+from typing import (
+    Iterable,
+    List,
+    Tuple,
+    Dict,
+    Set,
+    Any,
+    Callable,
+    TYPE_CHECKING,
+)
+from urllib.parse import urlparse
 
-import gitlab
+import requests
 import tabulate
-from gitlab import GitlabError
-from gitlab.v4.objects import Project, Group, ProjectBranch
+
+# shared with the tools in pkg_survey
+sys.path.insert(0, str(Path(__file__).resolve().parent / "pkg_survey"))
+from json_lines import JsonLinesJournal  # noqa: E402
+
+if TYPE_CHECKING:
+    # python-gitlab is imported when the client is needed, it takes a while
+    from gitlab import Gitlab
+    from gitlab.v4.objects import (
+        Group,
+        GroupProject,
+        ProjectBranch,
+        ProjectProtectedBranch,
+    )
 
 src_group_prefix = "redhat/centos-stream/src/"
 src_group_id = 9376152
@@ -21,25 +54,87 @@ src_group_id = 9376152
 # * c9s - actively being used
 # * there are some other repos kernel uses
 # kernel_src_group_id = 10873929
-gl = gitlab.Gitlab(
-    url="https://gitlab.com/", private_token=os.getenv("GITLAB_TOKEN", None)
-)
+# number of threads used to scan the group, 1 = the original sequential scan
+scan_workers = int(os.getenv("SCAN_WORKERS", "1"))
+# max number of requests per second sent to a single host, 0 = unlimited
+requests_per_second = float(os.getenv("GITLAB_RPS", "0"))
+# re-fetch branches of already scanned projects which changed since the last scan
+refresh = bool(os.getenv("REFRESH"))
+# number of threads running the bulk operations (archive, delete, lock down)
+bulk_workers = int(os.getenv("BULK_WORKERS", "4"))
+# how many times a bulk operation failing with 429 or 5xx is retried
+bulk_retries = int(os.getenv("BULK_RETRIES", "5"))
+RETRIABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Spread calls evenly so there are at most `rate` of them per second,
+    shared by all the threads using the limiter"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedSession(requests.Session):
+    """requests.Session which keeps every host under the requests-per-second cap"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.limiters: Dict[str, RateLimiter] = {}
+        self.limiters_lock = threading.Lock()
+
+    def get_limiter(self, host: str) -> RateLimiter:
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.rate)
+            return self.limiters[host]
+
+    def request(self, method, url, *args, **kwargs):
+        self.get_limiter(urlparse(url).netloc).wait()
+        return super().request(method, url, *args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def gitlab_client() -> "Gitlab":
+    """created on the first use, so that e.g. displaying packages.json doesn't need it"""
+    import gitlab
+
+    return gitlab.Gitlab(
+        url="https://gitlab.com/",
+        private_token=os.getenv("GITLAB_TOKEN", None),
+        session=RateLimitedSession(requests_per_second),
+    )
+
+
 packages_path = Path("./packages.json")
+# one record per scanned project, compacted into packages.json once the scan is over
+journal_path = Path("./packages.journal")
+# the journal is fsync'd after this many records
+journal_fsync_every = int(os.getenv("JOURNAL_FSYNC_EVERY", "50"))
 
 
-def iterate_group_projects(group: Group) -> Iterable[Project]:
-    """yield Project of a Group"""
-    page = 0
+def iterate_group_listing(group: "Group") -> Iterable["GroupProject"]:
+    """yield projects as listed in a Group, without fetching them one by one"""
+    page = 1
     while True:
-        projects = group.projects.list(lazy=True, page=page)
+        projects = group.projects.list(page=page, per_page=100)
         if not projects:  # EOF
             break
-
-        for project in projects:
-            # project doesn't contain the branches manager,
-            # also don't do lazy=True since we need name
-            manageable_project = gl.projects.get(project.id)
-            yield manageable_project
+        yield from projects
         page += 1
 
 
@@ -52,29 +147,181 @@ def transform_to_tabulate(data: Dict[str, Tuple]) -> List[Tuple]:
     )
 
 
-def collect_projects(c8s_projects: Dict, c9s_projects: Dict, group: Group):
+def classify_project(
+    project_name: str, branches_list: List[str], last_activity_at: str
+) -> Dict[str, Any]:
+    """create a journal record of the project: c9 if it has a c9 branch, c8 otherwise"""
+    project_group = "c9" if any(b.startswith("c9") for b in branches_list) else "c8"
+    print(f"[ {project_group} {branches_list}")
+    return {
+        "name": project_name,
+        "group": project_group,
+        "branches": branches_list,
+        "last_activity_at": last_activity_at,
+    }
+
+
+def apply_record(
+    record: Dict[str, Any], c8s_projects: Dict, c9s_projects: Dict, last_activity: Dict
+):
+    """store a journal record in the matching dict,
+    a newer record of a project overrides the older one"""
+    name = record["name"]
+    c8s_projects.pop(name, None)
+    c9s_projects.pop(name, None)
+    last_activity.pop(name, None)
+    if record.get("removed"):
+        return
+    if record["group"] == "c9":
+        c9s_projects[name] = record["branches"]
+    else:
+        c8s_projects[name] = record["branches"]
+    if record.get("last_activity_at"):
+        last_activity[name] = record["last_activity_at"]
+
+
+def needs_scan(
+    listed_project: "GroupProject",
+    c8s_projects: Dict,
+    c9s_projects: Dict,
+    last_activity: Dict,
+) -> bool:
+    """scan projects we don't know yet and, when refreshing,
+    also the ones which were active since they were scanned"""
+    name = listed_project.name
+    if name not in c9s_projects and name not in c8s_projects:
+        return True
+    return refresh and last_activity.get(name) != listed_project.last_activity_at
+
+
+def forget_removed_projects(
+    seen: Set[str],
+    c8s_projects: Dict,
+    c9s_projects: Dict,
+    last_activity: Dict,
+    journal: JsonLinesJournal,
+):
+    """drop projects which are no longer in the group, call only after a complete listing"""
+    for name in [n for n in [*c8s_projects, *c9s_projects] if n not in seen]:
+        print(f"Project {name} is gone")
+        record = {"name": name, "removed": True}
+        apply_record(record, c8s_projects, c9s_projects, last_activity)
+        journal.append(record)
+
+
+def write_packages(c8s_projects: Dict, c9s_projects: Dict, last_activity: Dict):
+    """atomically replace packages.json with the provided data"""
+    tmp_path = packages_path.with_name(packages_path.name + ".tmp")
+    with tmp_path.open("w") as tmp:
+        tmp.write(
+            json.dumps(
+                {"c9": c9s_projects, "c8": c8s_projects, "last_activity": last_activity}
+            )
+        )
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp_path, packages_path)
+
+
+def collect_projects(
+    c8s_projects: Dict,
+    c9s_projects: Dict,
+    last_activity: Dict,
+    group: "Group",
+    journal: JsonLinesJournal,
+):
     """Iterate through a provided group and process its projects.
-    packages.json is being continuously updated during the loop"""
-    for project in iterate_group_projects(group):
-        print(f"Project {project.name}")
-        if project.name in c9s_projects or project.name in c8s_projects:
+    Every processed project is appended to the journal during the loop"""
+    from gitlab import GitlabError
+
+    seen: Set[str] = set()
+    for listed_project in iterate_group_listing(group):
+        seen.add(listed_project.name)
+        print(f"Project {listed_project.name}")
+        if not needs_scan(listed_project, c8s_projects, c9s_projects, last_activity):
             print("> skip >")
             continue
+        # listed project doesn't contain the branches manager,
+        # also don't do lazy=True since we need name
+        project = gitlab_client().projects.get(listed_project.id)
         try:
-            branches: List[ProjectBranch] = project.branches.list()
+            branches: List["ProjectBranch"] = project.branches.list()
         except GitlabError as e:
             print(f"!!! {project.name}: {e}")
             raise e
-        branches_list = [b.name for b in branches]
-        if any(b.startswith("c9") for b in branches_list):
-            print(f"[ c9 {branches_list}")
-            c9s_projects[project.name] = branches_list
-        else:
-            print(f"[ c8 {branches_list}")
-            c8s_projects[project.name] = branches_list
+        record = classify_project(
+            project.name, [b.name for b in branches], listed_project.last_activity_at
+        )
+        apply_record(record, c8s_projects, c9s_projects, last_activity)
         # We are doing a few thousands HTTP requests here. GitLab API can block, return 500,
         # so we want to efficiently cache the replies on disk
-        packages_path.write_text(json.dumps({"c9": c9s_projects, "c8": c8s_projects}))
+        journal.append(record)
+    if refresh:
+        forget_removed_projects(
+            seen, c8s_projects, c9s_projects, last_activity, journal
+        )
+
+
+def fetch_project_branches(
+    listed_project: "GroupProject",
+) -> Tuple["GroupProject", List[str]]:
+    """get names of all branches of a listed project, runs in a worker thread"""
+    from gitlab import GitlabError
+
+    # the listing already contains the name, a lazy object is enough
+    # to reach the branches manager and saves one request per project
+    project = gitlab_client().projects.get(listed_project.id, lazy=True)
+    try:
+        branches: List["ProjectBranch"] = project.branches.list()
+    except GitlabError as e:
+        print(f"!!! {listed_project.name}: {e}")
+        raise e
+    return listed_project, [b.name for b in branches]
+
+
+def collect_projects_concurrently(
+    c8s_projects: Dict,
+    c9s_projects: Dict,
+    last_activity: Dict,
+    group: "Group",
+    journal: JsonLinesJournal,
+    workers: int,
+):
+    """Same as collect_projects, but the branches are fetched by a pool of threads.
+
+    The group listing is consumed as the pool makes progress: at most 2 * workers
+    projects are in flight at any time. Results are classified and appended
+    to the journal from this (the main) thread only.
+    """
+    in_flight: Set[Future] = set()
+    seen: Set[str] = set()
+
+    def process_done(done: Iterable[Future]):
+        for future in done:
+            listed_project, branches_list = future.result()
+            print(f"Project {listed_project.name}")
+            record = classify_project(
+                listed_project.name, branches_list, listed_project.last_activity_at
+            )
+            apply_record(record, c8s_projects, c9s_projects, last_activity)
+            journal.append(record)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for listed_project in iterate_group_listing(group):
+            seen.add(listed_project.name)
+            if not needs_scan(
+                listed_project, c8s_projects, c9s_projects, last_activity
+            ):
+                continue
+            if len(in_flight) >= 2 * workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                process_done(done)
+            in_flight.add(executor.submit(fetch_project_branches, listed_project))
+        process_done(wait(in_flight).done)
+    if refresh:
+        forget_removed_projects(
+            seen, c8s_projects, c9s_projects, last_activity, journal
+        )
 
 
 def display_packages(c9_packages, c8_packages):
@@ -93,73 +340,209 @@ def display_packages(c9_packages, c8_packages):
     )
 
 
+def call_with_retries(action: Callable[[str], None], project_name: str):
+    """run the action, retry it with an exponential backoff
+    when GitLab is rate limiting us or having a bad time"""
+    from gitlab import GitlabError
+
+    for attempt in range(bulk_retries + 1):
+        try:
+            return action(project_name)
+        except GitlabError as e:
+            if e.response_code not in RETRIABLE_STATUS_CODES or attempt == bulk_retries:
+                raise
+            delay = 2**attempt
+            print(f"!!! {project_name}: {e}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+def run_bulk_operation(
+    operation: str, project_names: List[str], action: Callable[[str], None]
+):
+    """Run the action for every project using a pool of BULK_WORKERS threads.
+
+    Outcome of every project is recorded in ./<operation>.ledger, projects done
+    in a previous (interrupted) run are skipped, the failed ones are tried again.
+    A failure of one project doesn't stop the others.
+    """
+    ledger = JsonLinesJournal(Path(f"./{operation}.ledger"))
+    status: Dict[str, str] = {}
+    for record in ledger.replay():
+        status[record["name"]] = record["status"]
+    todo = [name for name in project_names if status.get(name) != "done"]
+    print(f"{operation}: {len(project_names) - len(todo)} projects done already")
+
+    failed: Dict[str, str] = {}
+    try:
+        with ThreadPoolExecutor(max_workers=bulk_workers) as executor:
+            futures = {
+                executor.submit(call_with_retries, action, name): name for name in todo
+            }
+            try:
+                for future in as_completed(futures):
+                    name = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"!!! {operation} {name}: {e}")
+                        failed[name] = str(e)
+                        ledger.append(
+                            {"name": name, "status": "failed", "error": str(e)}
+                        )
+                    else:
+                        ledger.append({"name": name, "status": "done"})
+            except BaseException:
+                # interrupted: finish the running projects, don't start the queued ones
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        ledger.close()
+    print(f"{operation}: {len(todo) - len(failed)} done, {len(failed)} failed")
+    for name, error in sorted(failed.items()):
+        print(f"  {name}: {error}")
+
+
+def archive_c8s_project(project_name: str):
+    project = gitlab_client().projects.get(src_group_prefix + project_name)
+    project.description = (
+        "This repository will be removed by the end of March 2022 since it wasn't used "
+        "in the past 16 months. [More info]"
+        "(https://lists.centos.org/pipermail/centos-devel/2022-February/120222.html)."
+    )
+    project.save()
+    project.archive()
+    print(f"Project {project.name} archived.")
+
+
 def archive_c8s_projects(c8s_projects: List[str]):
     """set repositories to be archived"""
-    for project_name in c8s_projects:
-        project = gl.projects.get(src_group_prefix + project_name)
-        project.description = (
-            "This repository will be removed by the end of March 2022 since it wasn't used "
-            "in the past 16 months. [More info]"
-            "(https://lists.centos.org/pipermail/centos-devel/2022-February/120222.html)."
-        )
-        project.save()
-        project.archive()
-        print(f"Project {project.name} archived.")
+    run_bulk_operation("archive-c8s-projects", c8s_projects, archive_c8s_project)
+
+
+def delete_c8s_project(project_name: str):
+    project = gitlab_client().projects.get(src_group_prefix + project_name)
+    project.delete()
+    print(f"Project {project.name} DELETED.")
 
 
 def delete_c8s_projects(c8s_projects: List[str]):
     """DELETE repositories"""
-    for project_name in c8s_projects:
-        project = gl.projects.get(src_group_prefix + project_name)
-        project.delete()
-        print(f"Project {project.name} DELETED.")
+    run_bulk_operation("delete-c8s-projects", c8s_projects, delete_c8s_project)
+
+
+def is_locked_down(protected_branch: "ProjectProtectedBranch") -> bool:
+    """no one can push to or merge into the protected branch"""
+    return all(
+        level["access_level"] == 0
+        for level in protected_branch.push_access_levels
+        + protected_branch.merge_access_levels
+    )
+
+
+def lock_down_c8_branch_of_project(project_name: str):
+    project = gitlab_client().projects.get(src_group_prefix + project_name)
+    protected = {pb.name: pb for pb in project.protectedbranches.list(all=True)}
+    for branch in project.branches.list():
+        if not branch.name.startswith("c8"):
+            continue
+        if branch.name in protected:
+            # locked down by a retried run already
+            if is_locked_down(protected[branch.name]):
+                continue
+            # protected with other access levels, those can't be updated in place
+            project.protectedbranches.delete(branch.name)
+        project.protectedbranches.create(
+            {
+                "name": branch.name,
+                # 0 = no one can do that
+                # https://docs.gitlab.com/ee/api/protected_branches.html
+                "merge_access_level": 0,
+                "push_access_level": 0,
+            }
+        )
+        print(f"Branch {branch.name} of project {project.name} locked down.")
 
 
 def lock_down_c8_branch(c9s_projects: List[str]):
     """Configure the c8 branch so no one can edit it"""
-    for project_name in c9s_projects:
-        project = gl.projects.get(src_group_prefix + project_name)
-        for branch in project.branches.list():
-            if branch.name.startswith("c8"):
-                project.protectedbranches.create(
-                    {
-                        "name": branch.name,
-                        # 0 = no one can do that
-                        # https://docs.gitlab.com/ee/api/protected_branches.html
-                        "merge_access_level": 0,
-                        "push_access_level": 0,
-                    }
-                )
-                print(f"Branch {branch.name} of project {project.name} locked down.")
+    run_bulk_operation(
+        "lock-down-c8-branch", c9s_projects, lock_down_c8_branch_of_project
+    )
+
+
+def delete_c8_branches_of_project(project_name: str):
+    project = gitlab_client().projects.get(src_group_prefix + project_name)
+    for branch in project.branches.list():
+        if branch.name.startswith("c8"):
+            branch.delete()
+            print(f"Branch {branch.name} of project {project.name} DELETED.")
 
 
 def delete_c8_branches(c9s_projects: List[str]):
     """delete branches that start with c8"""
-    for project_name in c9s_projects:
-        project = gl.projects.get(src_group_prefix + project_name)
-        for branch in project.branches.list():
-            if branch.name.startswith("c8"):
-                branch.delete()
-                print(f"Branch {branch.name} of project {project.name} DELETED.")
+    run_bulk_operation(
+        "delete-c8-branches", c9s_projects, delete_c8_branches_of_project
+    )
+
+
+def load_packages() -> Tuple[Dict, Dict, Dict]:
+    """c8s-only projects, c9s projects and last_activity of packages.json"""
+    if not packages_path.is_file():
+        return {}, {}, {}
+    data = json.loads(packages_path.read_text())
+    return data.get("c8", {}), data.get("c9", {}), data.get("last_activity", {})
+
+
+def show_packages():
+    """display packages.json of the last scan, without talking to GitLab"""
+    c8s_projects, c9s_projects, _ = load_packages()
+    display_packages(c9s_projects, c8s_projects)
 
 
 def main():
     """
     By default, go through the /src/ group (namespace) and process every project.
     Store info about branches and distinct b/w c8s-only projects and c8s+c9s.
+
+    Set SCAN_WORKERS to scan the group with that many threads and GITLAB_RPS
+    to cap the number of requests per second sent to gitlab.com.
+
+    Scanned projects are journaled to packages.journal, which is replayed on top
+    of packages.json when resuming an interrupted scan and compacted into
+    packages.json at the end.
+
+    Set REFRESH to also re-fetch branches of projects whose last_activity_at
+    changed since they were scanned and to drop projects which are gone.
     """
-    src_group = gl.groups.get(id=src_group_id)
+    src_group = gitlab_client().groups.get(id=src_group_id)
 
-    c8s_projects: Dict[str, List[str]] = {}
-    c9s_projects: Dict[str, List[str]] = {}
-    if packages_path.is_file():
-        data = json.loads(packages_path.read_text())
-        c8s_projects = data.get("c8", {})
-        c9s_projects = data.get("c9", {})
+    # last_activity: project name -> its last_activity_at when its branches were fetched
+    c8s_projects, c9s_projects, last_activity = load_packages()
+    journal = JsonLinesJournal(journal_path, fsync_every=journal_fsync_every)
+    for record in journal.replay():
+        apply_record(record, c8s_projects, c9s_projects, last_activity)
 
-    collect_projects(c8s_projects, c9s_projects, src_group)
+    try:
+        if scan_workers > 1:
+            collect_projects_concurrently(
+                c8s_projects,
+                c9s_projects,
+                last_activity,
+                src_group,
+                journal,
+                scan_workers,
+            )
+        else:
+            collect_projects(
+                c8s_projects, c9s_projects, last_activity, src_group, journal
+            )
+    finally:
+        journal.close()
+        write_packages(c8s_projects, c9s_projects, last_activity)
+        journal.remove()
 
     display_packages(c9s_projects, c8s_projects)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,46 @@
 import os
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
-from shutil import copyfile
+from typing import Iterable, List, Optional, TYPE_CHECKING
 
 import git
-import requests
 
-from ogr.services.pagure import PagureService
+from pagure_listing import PagureListing
+
+if TYPE_CHECKING:
+    from ogr.services.pagure import PagureService
 
 logger = getLogger(__name__)
 
 work_dir = Path("/tmp/playground")
 readme_path = Path(__file__).parent / "README.md"
-service = PagureService(
-    token=os.getenv("PAGURE_TOKEN"), instance_url="https://git.stg.centos.org/"
-)
+
+
+@lru_cache(maxsize=None)
+def get_service() -> "PagureService":
+    """created on the first use, importing ogr takes a while"""
+    from ogr.services.pagure import PagureService
+
+    return PagureService(
+        token=os.getenv("PAGURE_TOKEN"), instance_url="https://git.stg.centos.org/"
+    )
 
 
 class AddMasterBranch:
+    # the master branch is the same in all the projects: a single commit with
+    # the README, created once in a scratch repo and pushed from there
+    scratch_repo = work_dir / "master-branch.git"
+    commit: Optional[str] = None
+    lock = threading.Lock()
+
     def __init__(self, pkg_name):
         self.pkg_name = pkg_name
-        self.project = service.get_project(namespace="source-git", repo=self.pkg_name)
-        self.pkg_dir = work_dir / self.pkg_name
+        self.project = get_service().get_project(
+            namespace="source-git", repo=self.pkg_name
+        )
 
     def run(self):
         logger.info(f"Processing package: {self.pkg_name}")
@@ -32,30 +50,55 @@ class AddMasterBranch:
             logger.info("\tCreating master branch")
             self.add_master()
 
+    @classmethod
+    def master_commit(cls) -> str:
+        """orphan commit with just the README, the repo of the project is not needed"""
+        with cls.lock:
+            if not cls.commit:
+                repo = git.Repo.init(cls.scratch_repo, bare=True)
+                blob = repo.git.hash_object("-w", str(readme_path))
+                repo.git.update_index(
+                    "--add", "--cacheinfo", f"100644,{blob},README.md"
+                )
+                tree = repo.git.write_tree()
+                cls.commit = repo.git.commit_tree(tree, m="Initialize master branch")
+        return cls.commit
+
     def add_master(self):
-        if not self.pkg_dir.is_dir():
-            git.Git(work_dir).clone(self.project.get_git_urls()["ssh"])
-        repo = git.Repo(self.pkg_dir)
-        copyfile(readme_path, self.pkg_dir / "README.md")
-        repo.index.add([str(self.pkg_dir / "README.md")])
-        repo.index.commit("Initialize master branch")
-        repo.git.push("origin", "master")
+        # push of a single commit, the size of the repository doesn't matter
+        git.Git(self.scratch_repo).push(
+            self.project.get_git_urls()["ssh"],
+            f"{self.master_commit()}:refs/heads/master",
+        )
 
-        # cleanup
-        shutil.rmtree(self.pkg_dir)
 
+def iterate_projects(page: str) -> Iterable[str]:
+    """yield names of projects from the paginated listing starting at the page"""
+    listing = PagureListing(per_page=int(os.getenv("PAGURE_PER_PAGE", "100")))
+    for p in listing.projects(page):
+        yield p["name"]
 
-if __name__ == "__main__":
+
+def add_master_branch(pkg_name: str) -> bool:
+    """False if adding the branch failed"""
+    try:
+        AddMasterBranch(pkg_name).run()
+    except Exception as ex:
+        logger.error(f"Adding master branch to {pkg_name} failed: {ex}")
+        return False
+    return True
+
+
+def main(pkg_names: Optional[List[str]] = None):
+    """add master branch to all the source-git projects (or just the ones specified)"""
     if not work_dir.is_dir():
         logger.warning("Your work_dir is missing.")
     page = "https://git.stg.centos.org/api/0/projects?namespace=source-git&short=true"
-    i = 0
-    while True:
-        logger.info(page)
-        r = requests.get(page)
-        for p in r.json()["projects"]:
-            AddMasterBranch(p["name"]).run()
-        page = r.json()["pagination"]["next"]
-        if not page:
-            break
-        i = i + 1
+    workers = int(os.getenv("MASTER_BRANCH_WORKERS", "8"))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(add_master_branch, pkg_names or iterate_projects(page)):
+            pass
+
+
+if __name__ == "__main__":
+    main()
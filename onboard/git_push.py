@@ -0,0 +1,111 @@
+import os
+import re
+import subprocess
+import tempfile
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, List
+
+from git import Repo
+
+logger = getLogger(__name__)
+
+UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+
+
+def parse_push_progress(progress: str) -> Dict[str, int]:
+    """objects and bytes sent, from what `git push --progress` writes to stderr"""
+    objects = re.search(r"Total (\d+) \(delta", progress)
+    written = re.findall(
+        r"Writing objects: 100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)", progress
+    )
+    return {
+        "objects": int(objects.group(1)) if objects else 0,
+        "bytes": int(float(written[-1][0]) * UNITS[written[-1][1]]) if written else 0,
+    }
+
+
+class SourceGitPusher:
+    """
+    Pushes the converted branch together with the sg-start tag in a single
+    atomic push, over SSH connections shared by all the pushes (and the checks
+    whether they're needed) to the same host, instead of a handshake per command.
+    """
+
+    def __init__(self, control_persist: int = 600):
+        # the path of a control socket is limited to ~100 characters
+        self.control_dir = Path(tempfile.gettempdir()) / f"onboard-ssh-{os.getuid()}"
+        self.control_persist = control_persist
+
+    @property
+    def env(self) -> Dict[str, str]:
+        """environment of git commands, with SSH multiplexing on top of GIT_SSH_COMMAND"""
+        self.control_dir.mkdir(mode=0o700, exist_ok=True)
+        ssh = os.getenv("GIT_SSH_COMMAND", "ssh")
+        return {
+            "GIT_SSH_COMMAND": f"{ssh} -o ControlMaster=auto "
+            f"-o ControlPath={self.control_dir}/%C -o ControlPersist={self.control_persist}"
+        }
+
+    @staticmethod
+    def local_refs(repo: Repo, refs: List[str]) -> Dict[str, str]:
+        output = repo.git.for_each_ref("--format=%(objectname) %(refname)", *refs)
+        return {ref: sha for sha, ref in (line.split() for line in output.splitlines())}
+
+    def remote_refs(self, repo: Repo, url: str, refs: List[str]) -> Dict[str, str]:
+        output = repo.git.ls_remote(url, *refs, env=self.env)
+        # only the refs themselves, not the peeled tags (refs/tags/sg-start^{})
+        return {
+            ref: sha
+            for sha, ref in (line.split() for line in output.splitlines())
+            if ref in refs
+        }
+
+    def push(
+        self, repo_path: Path, url: str, branch: str, force_tag: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Push the branch and the sg-start tag to url unless the remote has them already.
+
+        :param force_tag: the tag is moved by an update, it has to be forced
+        :return: push (pushed or up-to-date), push_objects and push_bytes sent
+        """
+        repo = Repo(repo_path)
+        refs = [f"refs/heads/{branch}", "refs/tags/sg-start"]
+        local = self.local_refs(repo, refs)
+        if self.remote_refs(repo, url, refs) == local:
+            logger.info(f"{url} is up-to-date, nothing to push.")
+            return {"push": "up-to-date", "push_objects": 0, "push_bytes": 0}
+
+        refspecs = [
+            f"{'+' if force_tag and ref.startswith('refs/tags/') else ''}{ref}:{ref}"
+            for ref in refs
+            if ref in local
+        ]
+        _, porcelain, progress = repo.git.push(
+            "--atomic",
+            "--porcelain",
+            "--progress",
+            url,
+            *refspecs,
+            env=self.env,
+            with_extended_output=True,
+        )
+        logger.info(porcelain)
+        sent = parse_push_progress(progress)
+        return {
+            "push": "pushed",
+            "push_objects": sent["objects"],
+            "push_bytes": sent["bytes"],
+        }
+
+    def close(self):
+        """stop the shared SSH connections, instead of leaving them to ControlPersist"""
+        if not self.control_dir.is_dir():
+            return
+        for socket in self.control_dir.iterdir():
+            subprocess.run(
+                ["ssh", "-o", f"ControlPath={socket}", "-O", "exit", "placeholder"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+
+class MetadataCache:
+    """
+    Results of forge metadata lookups (branches, existence of projects)
+    reused for `ttl` seconds, also by the next runs once saved to `path`.
+    Safe to be used from several threads.
+    """
+
+    def __init__(self, path: Path, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path.is_file():
+            self.entries = json.loads(path.read_text())
+
+    def get(self, key: str, lookup: Callable[[], Any]) -> Any:
+        """cached value of the key, lookup() is called when it's missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.time() - entry["time"] < self.ttl:
+            return entry["value"]
+        value = lookup()
+        with self.lock:
+            self.entries[key] = {"time": time.time(), "value": value}
+        return value
+
+    def forget(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            now = time.time()
+            entries = {
+                key: entry
+                for key, entry in self.entries.items()
+                if now - entry["time"] < self.ttl
+            }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(entries))
+        os.replace(tmp_path, self.path)
@@ -1,10 +1,10 @@
 import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
 from pathlib import Path
-from typing import List, Optional
-
-from git import Repo
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
 from ogr import GitlabService
 from ogr.abstract import AccessLevel, GitService, GitProject
@@ -12,13 +12,44 @@ from ogr.services.gitlab import GitlabProject
 from ogr.services.pagure import PagureService
 
 from add_master_branch import AddMasterBranch
-from survey import CentosPkgValidatedConvert
+from git_push import SourceGitPusher
+from metadata_cache import MetadataCache
+from pipeline import Pipeline, Stage
+from result_sink import ResultSink
+from stage_metrics import measure, report
+from survey import (
+    CentosPkgValidatedConvert,
+    cache_dir,
+    lease_ttl,
+    work_queue_path,
+    workspaces,
+)
+from work_queue import WorkQueue
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=getenv("LOGLEVEL", "INFO"))
 
 C8S_BRANCHES = ["c8s", "c8s-stream-rhel", "c8"]
-work_dir = Path("/tmp/playground")
+
+
+class PackageJob:
+    """a package going through the onboarding stages"""
+
+    def __init__(self, pkg_name: str, branch: Optional[str], skip_build: bool = False):
+        self.pkg_name = pkg_name
+        # None = find out from dist-git
+        self.branch = branch
+        self.skip_build = skip_build
+        self.project: Optional[GitProject] = None
+        self.sg_exists = False
+        # metadata resolved already, by the pre-flight
+        self.prepared = False
+        self.converter: Optional[CentosPkgValidatedConvert] = None
+        # what was recorded in the result sink
+        self.result: Optional[Dict[str, Any]] = None
+
+    def __str__(self):
+        return self.pkg_name
 
 
 class OnboardCentosPKG:
@@ -29,12 +60,27 @@ class OnboardCentosPKG:
         maintainers: List[str],
         maintainers_group: List[str],
         update: bool,
+        result_sink: ResultSink,
+        metadata_cache: MetadataCache,
+        work_queue: Optional[WorkQueue] = None,
     ):
         self.service = service
         self.namespace = namespace
         self.maintainers = maintainers
         self.maintainers_group = maintainers_group
         self.update = update
+        self.result_sink = result_sink
+        self.metadata_cache = metadata_cache
+        # jobs leased from the queue are completed there as well
+        self.work_queue = work_queue
+        self.pusher = SourceGitPusher()
+        dg_token = getenv("DISTGIT_TOKEN")
+        # a single instance, so that the connections are reused
+        self.distgit_service = (
+            PagureService(token=dg_token, instance_url="https://git.centos.org/")
+            if dg_token
+            else None
+        )
 
     def create_sg_repo(self, pkg_name: str) -> GitProject:
         logger.info(
@@ -63,16 +109,17 @@ class OnboardCentosPKG:
 
         return project
 
-    @staticmethod
-    def get_distgit_branch(pkg_name: str) -> Optional[str]:
+    def get_distgit_branch(self, pkg_name: str) -> Optional[str]:
         logger.info("No branch specified. Inspecting dist-git.")
-        dg_token = getenv("DISTGIT_TOKEN")
-        if not dg_token:
+        if not self.distgit_service:
             logger.error(f"No DISTGIT_TOKEN specified. Trying {C8S_BRANCHES[0]}")
             return C8S_BRANCHES[0]
-        service = PagureService(token=dg_token, instance_url="https://git.centos.org/")
-        dg_project = service.get_project(namespace="rpms", repo=pkg_name)
-        branches = dg_project.get_branches()
+        branches = self.metadata_cache.get(
+            f"rpms/{pkg_name}",
+            lambda: self.distgit_service.get_project(
+                namespace="rpms", repo=pkg_name
+            ).get_branches(),
+        )
         for b in C8S_BRANCHES:
             if b in branches:
                 return b
@@ -80,66 +127,239 @@ class OnboardCentosPKG:
             logger.error(f"No {C8S_BRANCHES} branch in dist-git repo of {pkg_name}.")
             return None
 
-    def run(self, pkg_name: str, branch: str, skip_build: bool = False):
-        action = "Updating" if self.update else "Onboarding"
+    @property
+    def action(self) -> str:
+        return "Updating" if self.update else "Onboarding"
+
+    def lookup_source_git(self, project: GitProject, branch: str) -> Dict[str, Any]:
+        """whether the source-git project exists and its branches"""
+        if not project.exists():
+            return {"exists": False, "branches": []}
+        branches = project.get_branches()
+        if (
+            branch in branches
+            and isinstance(project, GitlabProject)
+            and project.gitlab_repo.visibility == "private"
+        ):
+            logger.info("Making the repository public.")
+            project.gitlab_repo.visibility = "public"
+            project.gitlab_repo.save()
+        return {"exists": True, "branches": branches}
 
-        if not branch:
-            logger.info(f"No branch. {action} {pkg_name} canceled.")
-            return
+    def prepare(self, job: PackageJob) -> bool:
+        """find out the branch and what's in the source-git repo,
+        False if the package doesn't need to be onboarded"""
+        if job.prepared:
+            return True
+        if job.branch is None:
+            job.branch = self.get_distgit_branch(pkg_name=job.pkg_name)
+        if not job.branch:
+            logger.info(f"No branch. {self.action} {job.pkg_name} canceled.")
+            return False
 
         logger.info(
-            f"{action} {pkg_name} using {branch} branch."
-            f"{' Skipping build.' if skip_build else ''}"
+            f"{self.action} {job.pkg_name} using {job.branch} branch."
+            f"{' Skipping build.' if job.skip_build else ''}"
         )
 
-        project = self.service.get_project(namespace=self.namespace, repo=pkg_name)
-        sg_exists = False
-        if project.exists():
-            logger.info(f"Source repo for {pkg_name} already exists")
-            if branch in project.get_branches():
-                logger.info(f"Branch {branch} already exists")
-                if (
-                    isinstance(project, GitlabProject)
-                    and project.gitlab_repo.visibility == "private"
-                ):
-                    logger.info("Making the repository public.")
-                    project.gitlab_repo.visibility = "public"
-                    project.gitlab_repo.save()
+        project = self.service.get_project(namespace=self.namespace, repo=job.pkg_name)
+        job.project = project
+        source_git = self.metadata_cache.get(
+            f"{self.namespace}/{job.pkg_name}",
+            lambda: self.lookup_source_git(project, job.branch),
+        )
+        if source_git["exists"]:
+            logger.info(f"Source repo for {job.pkg_name} already exists")
+            if job.branch in source_git["branches"]:
+                logger.info(f"Branch {job.branch} already exists")
                 if not self.update:
-                    return
-            sg_exists = True
-        converter = CentosPkgValidatedConvert(
-            package_name=pkg_name, distgit_branch=branch
+                    return False
+            job.sg_exists = True
+        job.prepared = True
+        return True
+
+    def preflight(self, jobs: List[PackageJob]) -> List[PackageJob]:
+        """
+        Resolve metadata of all the jobs concurrently before any work starts,
+        return only the jobs which need to be processed.
+        """
+
+        def try_prepare(job: PackageJob) -> bool:
+            try:
+                return self.prepare(job)
+            except Exception:
+                # not prepared, the job itself will try again and report it
+                logger.exception(f"Pre-flight failed for {job}")
+                return True
+
+        workers = int(getenv("PREFLIGHT_WORKERS", "8"))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            needed = list(executor.map(try_prepare, jobs))
+        self.metadata_cache.save()
+        logger.info(f"Pre-flight: {sum(needed)} of {len(jobs)} packages to process.")
+        return [job for job, job_needed in zip(jobs, needed) if job_needed]
+
+    def clone(self, job: PackageJob) -> bool:
+        job.converter = CentosPkgValidatedConvert(
+            package_name=job.pkg_name, distgit_branch=job.branch
         )
-        converter.run(skip_build=skip_build, clone_sg=sg_exists)
-        logger.info(f"converter.result: {converter.result}")
-        with open("/in/result.yml", "a+") as out:
-            out.write(f"{converter.result}\n")
-        if (
-            not converter.result
-            or "error" in converter.result
-            or converter.result.get("conditional_patch")
-        ):
-            logger.warning(f"{action} aborted for {pkg_name}:")
-            return
-        logger.info(f"{action} successful for {pkg_name}:")
-        if not project.exists():
-            project = self.create_sg_repo(pkg_name)
+        if job.converter.fetch(clone_sg=job.sg_exists):
+            return True
+        return self.record(job)
 
-        git_repo = Repo(converter.src_package_dir)
-        git_repo.create_remote("packit", project.get_git_urls()["ssh"])
-        git_repo.git.push("packit", branch)
-        # dist2src update moves sg-start tag, we also need --force to move it in remote
-        git_repo.git.push("packit", branch, tags=True, force=self.update)
+    def convert(self, job: PackageJob) -> bool:
+        if job.converter.process():
+            return True
+        return self.record(job)
 
-        converter.cleanup()
+    def build(self, job: PackageJob, mock_uniqueext: Optional[str] = None) -> bool:
+        if not job.skip_build:
+            job.converter.mock_uniqueext = mock_uniqueext
+            job.converter.do_mock_build()
+        return self.record(job)
 
+    def build_in_own_root(self, job: PackageJob) -> bool:
+        """build stage for concurrent builds, each worker thread has its own mock root"""
+        return self.build(job, mock_uniqueext=threading.current_thread().name)
 
-if __name__ == "__main__":
+    def save_result(self, job: PackageJob):
+        result = job.converter.result
+        logger.info(f"converter.result: {result}")
+        if result:
+            result["stages"] = job.converter.stages
+        job.result = result or {"package_name": job.pkg_name}
+        self.result_sink.append(job.result)
 
+    def record(self, job: PackageJob) -> bool:
+        """record the result of an aborted conversion, True if the package can be pushed,
+        results of pushed packages are recorded once they're pushed"""
+        result = job.converter.result
+        if not result or "error" in result or result.get("conditional_patch"):
+            self.save_result(job)
+            job.converter.cleanup()
+            logger.warning(f"{self.action} aborted for {job.pkg_name}:")
+            return False
+        logger.info(f"{self.action} successful for {job.pkg_name}:")
+        return True
+
+    def push(self, job: PackageJob) -> bool:
+        with measure(job.converter.stages, "push"):
+            project = job.project
+            # found out by prepare, from the metadata cache
+            if not job.sg_exists:
+                project = self.create_sg_repo(job.pkg_name)
+
+            job.converter.result.update(
+                self.pusher.push(
+                    job.converter.src_package_dir,
+                    project.get_git_urls()["ssh"],
+                    job.branch,
+                    # dist2src update moves sg-start tag, it has to be forced in remote
+                    force_tag=self.update,
+                )
+            )
+
+        self.save_result(job)
+        # the source-git repo has changed
+        self.metadata_cache.forget(f"{self.namespace}/{job.pkg_name}")
+        job.converter.cleanup()
+        return True
+
+    def finish(self, job: PackageJob):
+        """the job went through all the stages it needed"""
+        # stages release the workspace once they're done with it, releasing it again does nothing
+        if job.converter:
+            job.converter.cleanup()
+        if self.work_queue:
+            self.work_queue.complete(job.pkg_name, job.result)
+
+    def fail(self, job: PackageJob):
+        """a stage raised, the package is given back to the queue to be tried again"""
+        if job.converter:
+            job.converter.cleanup()
+        if self.work_queue:
+            self.work_queue.release(job.pkg_name)
+
+    def run_job(self, job: PackageJob):
+        stages: List[Callable[[PackageJob], bool]] = [
+            self.prepare,
+            self.clone,
+            self.convert,
+            self.build,
+            self.push,
+        ]
+        for stage in stages:
+            try:
+                passed = stage(job)
+            except Exception:
+                logger.exception(f"{self.action} failed for {job.pkg_name}")
+                self.fail(job)
+                return
+            if not passed:
+                break
+        self.finish(job)
+
+    def leased_jobs(self, skip_build: bool = False) -> Iterable[PackageJob]:
+        """jobs of packages leased from the queue, until there are none left"""
+        while True:
+            lease = self.work_queue.lease()
+            if lease is None:
+                return
+            pkg_name, branch = lease
+            yield PackageJob(pkg_name, branch, skip_build=skip_build)
+
+    def run(self, pkg_name: str, branch: Optional[str], skip_build: bool = False):
+        self.run_job(PackageJob(pkg_name, branch, skip_build=skip_build))
+
+    def run_pipeline(self, jobs: Iterable[PackageJob]):
+        """
+        Run the stages of all the jobs concurrently, so that e.g. packages are
+        cloned while another one is being built. Number of workers of the stages
+        is configured by PIPELINE_<STAGE>_WORKERS env vars.
+        """
+
+        def workers(stage: str, default: int) -> int:
+            return int(getenv(f"PIPELINE_{stage.upper()}_WORKERS", default))
+
+        build_workers = workers("build", 1)
+        build: Callable[[PackageJob], bool] = self.build
+        if build_workers > 1:
+            build = self.build_in_own_root
+        pipeline = Pipeline(
+            [
+                Stage("prepare", self.prepare, workers("prepare", 4)),
+                Stage("clone", self.clone, workers("clone", 4)),
+                # Dist2Src runs are CPU bound
+                Stage("convert", self.convert, workers("convert", 1)),
+                Stage("build", build, build_workers),
+                Stage("push", self.push, workers("push", 2)),
+            ],
+            queue_size=int(getenv("PIPELINE_QUEUE_SIZE", "2")),
+            on_done=self.finish,
+            on_error=self.fail,
+        )
+        pipeline.run(jobs)
+        logger.info(f"Pipeline throughput:\n{pipeline.report()}")
+
+
+def main(in_pkgs: Optional[List[str]] = None):
+    """
+    Onboard (UPDATE: update) packages listed in /in/input-pkgs.yml
+    (/in/update-pkgs.yml), or the specified ones, as package[:branch].
+    With WORK_QUEUE set, the packages are shared with other hosts.
+    """
     pagure_token = getenv("PAGURE_TOKEN")
     gitlab_token = getenv("GITLAB_TOKEN")
     update = bool(getenv("UPDATE"))
+    result_sink = ResultSink(Path("/in/result.jsonl"))
+    metadata_cache = MetadataCache(
+        cache_dir / "metadata.json", ttl=int(getenv("METADATA_TTL", "3600"))
+    )
+    work_queue = (
+        WorkQueue(Path(work_queue_path), lease_ttl=lease_ttl)
+        if work_queue_path
+        else None
+    )
     if pagure_token:
         ocp = OnboardCentosPKG(
             service=PagureService(
@@ -149,6 +369,9 @@ if __name__ == "__main__":
             maintainers=["centosrcm"],
             maintainers_group=["git-packit-team"],
             update=update,
+            result_sink=result_sink,
+            metadata_cache=metadata_cache,
+            work_queue=work_queue,
         )
     elif gitlab_token:
         ocp = OnboardCentosPKG(
@@ -159,24 +382,64 @@ if __name__ == "__main__":
             maintainers=[],
             maintainers_group=[],
             update=update,
+            result_sink=result_sink,
+            metadata_cache=metadata_cache,
+            work_queue=work_queue,
         )
     else:
         logger.error("Define PAGURE_TOKEN or GITLAB_TOKEN")
         sys.exit(1)
 
-    work_dir.joinpath("rpms").mkdir(parents=True, exist_ok=True)
-    work_dir.joinpath("src").mkdir(parents=True, exist_ok=True)
+    # left behind by crashed runs
+    workspaces.reclaim_stale()
 
-    in_file = "/in/update-pkgs.yml" if update else "/in/input-pkgs.yml"
-    with open(in_file, "r") as f:
-        in_pkgs = f.readlines()
+    if not in_pkgs:
+        in_file = "/in/update-pkgs.yml" if update else "/in/input-pkgs.yml"
+        with open(in_file, "r") as f:
+            in_pkgs = f.readlines()
+    # skip packages processed by an interrupted run
+    recorded = result_sink.recorded_packages() if getenv("RESUME") else set()
+    skip_build = bool(getenv("SKIP_BUILD"))
+    jobs = []
     for pkg in in_pkgs:
         if not pkg.strip() or pkg.startswith("#"):
             continue
 
         split = pkg.strip().split(":", maxsplit=1)
-        if len(split) == 2:
-            package, branch = split
-        else:
-            package, branch = split[0], ocp.get_distgit_branch(pkg_name=split[0])
-        ocp.run(pkg_name=package, branch=branch, skip_build=bool(getenv("SKIP_BUILD")))
+        if split[0] in recorded:
+            logger.info(f"{split[0]} processed already, skipping.")
+            continue
+        # without a branch, it's picked from dist-git
+        branch = split[1] if len(split) == 2 else None
+        jobs.append(PackageJob(split[0], branch, skip_build=skip_build))
+
+    pending: Iterable[PackageJob]
+    if work_queue:
+        # all the hosts queue the same packages, each of them is processed once
+        added = work_queue.add([(job.pkg_name, job.branch) for job in jobs])
+        logger.info(f"Queued {added} packages.")
+        # leased one by one, metadata is resolved by the prepare stage
+        pending = ocp.leased_jobs(skip_build=skip_build)
+    else:
+        pending = ocp.preflight(jobs)
+    if getenv("PIPELINE"):
+        ocp.run_pipeline(pending)
+    else:
+        for job in pending:
+            ocp.run_job(job)
+    metadata_cache.save()
+    ocp.pusher.close()
+    if work_queue:
+        # results of all the hosts so far, complete once the last one is done
+        work_queue.export_yaml(Path("/in/result.yml"))
+        records = work_queue.results()
+        logger.info(f"Queue: {work_queue.status()}")
+    else:
+        result_sink.export_yaml(Path("/in/result.yml"))
+        records = result_sink.records()
+    logger.info(f"Stages:\n{report(records)}")
+    workspaces.wait()
+
+
+if __name__ == "__main__":
+    main()
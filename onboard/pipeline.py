@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from queue import Queue
+from typing import Any, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# put into a queue to tell one worker of the stage there's nothing more to do
+STOP = object()
+
+
+class Stage:
+    """
+    A step of the pipeline run by its own pool of `workers` threads.
+
+    `func` processes an item and returns True to pass it to the next stage,
+    False to drop it (it was processed completely or there's nothing more to do).
+    An item is also dropped if `func` raises.
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], bool], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.passed = 0
+        self.errors = 0
+        self.busy = 0.0
+
+    def process(self, item: Any) -> bool:
+        start = time.monotonic()
+        passed = False
+        try:
+            passed = self.func(item)
+        except Exception:
+            logger.exception(f"Stage {self.name} failed for {item}")
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.processed += 1
+                self.passed += bool(passed)
+                self.busy += time.monotonic() - start
+        return passed
+
+
+class Pipeline:
+    """
+    Items flow through the stages in order, stages run concurrently.
+
+    There's a bounded queue in front of every stage, so a fast stage
+    can get at most `queue_size` items ahead of a slow one instead
+    of e.g. cloning everything while the first build is running.
+
+    `on_done` is called with every item leaving the pipeline,
+    dropped by a stage or passed by the last one, `on_error` instead
+    of it with items dropped because a stage raised.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 2,
+        on_done: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[Any], None]] = None,
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_done = on_done
+        self.on_error = on_error
+        self.wall = 0.0
+
+    def work(self, stage: Stage, queue: Queue, next_queue: Optional[Queue]):
+        while True:
+            item = queue.get()
+            if item is STOP:
+                return
+            try:
+                passed = stage.process(item)
+            except Exception:
+                self.leave(item, self.on_error)
+                continue
+            if passed and next_queue is not None:
+                next_queue.put(item)
+            else:
+                self.leave(item, self.on_done)
+
+    @staticmethod
+    def leave(item: Any, callback: Optional[Callable[[Any], None]]):
+        if not callback:
+            return
+        try:
+            callback(item)
+        except Exception:
+            logger.exception(f"Finishing {item} failed")
+
+    def run(self, items: Iterable[Any]):
+        start = time.monotonic()
+        queues: List[Queue] = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads: List[List[threading.Thread]] = []
+        for index, stage in enumerate(self.stages):
+            next_queue = queues[index + 1] if index + 1 < len(self.stages) else None
+            stage_threads = [
+                threading.Thread(
+                    target=self.work,
+                    args=(stage, queues[index], next_queue),
+                    name=f"{stage.name}-{worker}",
+                    daemon=True,
+                )
+                for worker in range(stage.workers)
+            ]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+
+        for item in items:
+            queues[0].put(item)
+        # stop the stages one after another, a stage can still pass items
+        # to the next one until all its workers are done
+        for stage, queue, stage_threads in zip(self.stages, queues, threads):
+            for _ in stage_threads:
+                queue.put(STOP)
+            for thread in stage_threads:
+                thread.join()
+        self.wall = time.monotonic() - start
+
+    def report(self) -> str:
+        """per-stage throughput of the last run"""
+        lines = [
+            f"{'stage':<10} {'workers':>7} {'items':>6} {'passed':>6} {'errors':>6} "
+            f"{'busy [s]':>9} {'util.':>6} {'items/h':>8}"
+        ]
+        for stage in self.stages:
+            utilization = stage.busy / (stage.workers * self.wall) if self.wall else 0
+            per_hour = stage.processed / self.wall * 3600 if self.wall else 0
+            lines.append(
+                f"{stage.name:<10} {stage.workers:>7} {stage.processed:>6} "
+                f"{stage.passed:>6} {stage.errors:>6} {stage.busy:>9.0f} "
+                f"{utilization:>6.0%} {per_hour:>8.1f}"
+            )
+        lines.append(f"wall time: {self.wall:.0f}s")
+        return "\n".join(lines)
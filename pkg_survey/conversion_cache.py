@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+from functools import lru_cache
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import git
+
+from dir_size import measure_tree
+
+logger = getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def distribution_version(distribution: str) -> str:
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # python < 3.8 (the container), pkg_resources takes a while to import
+        from pkg_resources import get_distribution  # type: ignore[import]
+
+        return get_distribution(distribution).version
+    return version(distribution)
+
+
+class ConversionCache:
+    """
+    Results of Dist2Src conversions, addressed by what the conversion depends on:
+    the dist-git commit, the source-git commit it's done on top of (if any),
+    the branch and the version of dist2src.
+
+    An entry holds a git bundle of what the conversion added to the source-git
+    repo, the SRPM and the result of the conversion. Entries are immutable,
+    so concurrent processes can share the cache. Least recently used entries
+    are removed once the cache grows over max_size bytes.
+    """
+
+    def __init__(
+        self, cache_dir: Path, tool: str, max_size: int, check_size_every: int = 20
+    ):
+        self.cache_dir = cache_dir
+        # distribution doing the conversions
+        self.tool = tool
+        self.max_size = max_size
+        self.check_size_every = check_size_every
+        self.stores = 0
+
+    @property
+    def tool_version(self) -> str:
+        return distribution_version(self.tool)
+
+    def entry_path(
+        self, distgit_commit: str, sourcegit_commit: Optional[str], branch: str
+    ) -> Path:
+        key = "\n".join(
+            (distgit_commit, sourcegit_commit or "", branch, self.tool_version)
+        )
+        return self.cache_dir / sha256(key.encode()).hexdigest()
+
+    def store(
+        self,
+        entry: Path,
+        src_dir: Path,
+        base_commit: Optional[str],
+        srpm_path: Path,
+        result: Dict[str, Any],
+    ):
+        """add the converted src_dir (built on top of base_commit) to the cache"""
+        if entry.is_dir():
+            return
+        tmp = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        if tmp.is_dir():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        # branches and tags, tags are needed when pushing the source-git repo
+        refs = ["--branches", "--tags"] + ([f"^{base_commit}"] if base_commit else [])
+        git.Git(src_dir).bundle("create", str(tmp / "source-git.bundle"), *refs)
+        shutil.copy2(srpm_path, tmp / srpm_path.name)
+        (tmp / "result.json").write_text(
+            json.dumps({"srpm": srpm_path.name, "result": result})
+        )
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp)
+        self.stores += 1
+        # on the first store of a run and then every check_size_every stores
+        if (self.stores - 1) % self.check_size_every == 0:
+            self.enforce_max_size()
+
+    def enforce_max_size(self):
+        """remove least recently used entries until the cache fits into max_size"""
+        entries = []
+        for entry in self.cache_dir.glob("*"):
+            if entry.suffix in (".tmp", ".trash"):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+        sizes = {entry: measure_tree(entry)["total"] for _, entry in entries}
+        total = sum(sizes.values())
+        for _, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.info(f"Removing {entry}, conversion cache is over its limit")
+            # out of the way first, a half-removed entry would be a hit
+            trash = entry.with_name(f"{entry.name}.{os.getpid()}.trash")
+            try:
+                os.rename(entry, trash)
+            except OSError:
+                # removed by another process
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= sizes[entry]
+
+    @staticmethod
+    def restore(entry: Path, src_dir: Path, branch: str) -> Optional[Dict[str, Any]]:
+        """
+        Recreate the converted src_dir from the cache entry, the source-git
+        clone the conversion was done on top of has to be in src_dir already.
+
+        :return: the cached result with the path to the restored SRPM, None on a miss
+        """
+        if not entry.is_dir():
+            return None
+        # recently used, see enforce_max_size()
+        os.utime(entry)
+        cached = json.loads((entry / "result.json").read_text())
+        if not src_dir.is_dir():
+            git.Repo.init(src_dir)
+        repo = git.Git(src_dir)
+        repo.fetch(
+            "--update-head-ok",
+            str(entry / "source-git.bundle"),
+            "+refs/heads/*:refs/heads/*",
+            "+refs/tags/*:refs/tags/*",
+        )
+        repo.checkout("--force", branch)
+        repo.reset("--hard", branch)
+        srpm_path = src_dir / cached["srpm"]
+        shutil.copy2(entry / cached["srpm"], srpm_path)
+        cached["srpm"] = srpm_path
+        return cached
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+from typing import Dict, Set, Tuple
+
+
+def measure_tree(path: Path) -> Dict[str, int]:
+    """
+    Walk the tree in-process and return exact sizes in bytes:
+
+    * total: everything
+    * git: the .git directory
+    * worktree: everything else
+    * objects: objects of the repository in .git, loose and packed
+      (size + size-pack of `git count-objects -v`)
+
+    Symlinks are not followed, hard-linked files are counted once.
+    """
+    sizes = {"total": 0, "git": 0, "worktree": 0, "objects": 0}
+    seen_inodes: Set[Tuple[int, int]] = set()
+    root = str(path)
+    objects_dir = os.path.join(root, ".git", "objects")
+    pack_dir = os.path.join(objects_dir, "pack")
+    # (directory, whether it's inside .git)
+    stack = [(root, False)]
+    while stack:
+        directory, in_git = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                top_level_git = directory == root and entry.name == ".git"
+                stack.append((entry.path, in_git or top_level_git))
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # removed in the meantime
+                continue
+            if stat.st_nlink > 1:
+                if (stat.st_dev, stat.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((stat.st_dev, stat.st_ino))
+            sizes["total"] += stat.st_size
+            sizes["git" if in_git else "worktree"] += stat.st_size
+            if directory == pack_dir:
+                if entry.name.endswith((".pack", ".idx")):
+                    sizes["objects"] += stat.st_size
+            elif os.path.dirname(directory) == objects_dir:
+                # loose objects are in directories named by the first 2 digits of their hash
+                if len(os.path.basename(directory)) == 2:
+                    sizes["objects"] += stat.st_size
+    return sizes
@@ -0,0 +1,148 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import git
+
+from dir_size import measure_tree
+
+logger = getLogger(__name__)
+
+
+class GitMirrorCache:
+    """
+    Bare mirrors of remote repositories kept on disk between runs.
+
+    A mirror is created on the first use and only incrementally fetched
+    afterwards. Working copies are cloned from it with --shared, so they
+    don't even copy the objects. Least recently used mirrors are removed
+    once the cache grows over max_size bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_size: int,
+        check_size_every: int = 20,
+        min_age: int = 24 * 3600,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.check_size_every = check_size_every
+        # working copies borrow objects of the mirror, don't pull
+        # the rug from under the ones which might still be around
+        self.min_age = min_age
+        self.updates = 0
+
+    def mirror_path(self, url: str) -> Path:
+        name = url.rstrip("/").rsplit("/", 1)[-1]
+        digest = hashlib.sha256(url.encode()).hexdigest()[:12]
+        return self.cache_dir / f"{name}-{digest}.git"
+
+    @contextmanager
+    def locked(self, mirror: Path, blocking: bool = True):
+        """exclusive lock of the mirror, shared by all processes using the cache"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(f"{mirror}.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    @staticmethod
+    def remote_branch_commit(url: str, branch: str) -> Optional[str]:
+        """hash of the branch head in the remote repository, None if there's no such branch,
+        costs a single ref advertisement, no objects are transferred"""
+        refs = str(git.Git().ls_remote("--heads", url, f"refs/heads/{branch}"))
+        return refs.split()[0] if refs else None
+
+    def update(
+        self, url: str, branch: Optional[str] = None, depth: Optional[int] = None
+    ) -> Path:
+        """
+        Create the mirror of url or fetch what's new in it.
+
+        :param branch: fetch only this branch, tags pointing into it and sg-start
+        :param depth: fetch only this many commits of the history,
+                      a shallow mirror gets the whole of it without depth
+        """
+        mirror = self.mirror_path(url)
+        with self.locked(mirror):
+            if not (mirror / "HEAD").is_file():
+                logger.info(f"Creating mirror of {url} in {mirror}")
+                tmp = mirror.with_suffix(".tmp")
+                if tmp.is_dir():
+                    shutil.rmtree(tmp)
+                repo = git.Repo.init(tmp, bare=True)
+                repo.git.remote("add", "origin", url)
+                # branches and tags only, forges also have refs of pull-requests
+                repo.git.config(
+                    "remote.origin.fetch",
+                    "+refs/heads/*:refs/heads/*",
+                    replace_all=True,
+                )
+                repo.git.config(
+                    "--add", "remote.origin.fetch", "+refs/tags/*:refs/tags/*"
+                )
+                os.rename(tmp, mirror)
+            fetch_args = [f"--depth={depth}"] if depth else []
+            if not depth and (mirror / "shallow").is_file():
+                # created shallow by an earlier run, the whole history is wanted now
+                fetch_args = ["--unshallow"]
+            if branch:
+                fetch_args += [
+                    "origin",
+                    f"+refs/heads/{branch}:refs/heads/{branch}",
+                    # tags already in the mirror are not updated by fetching the branch,
+                    # a glob so that repos without the tag (dist-git) don't fail
+                    "+refs/tags/sg-start*:refs/tags/sg-start*",
+                ]
+            else:
+                fetch_args += ["--prune", "origin"]
+            git.Git(mirror).fetch(*fetch_args)
+            os.utime(mirror)
+        self.updates += 1
+        # on the first update of a run and then every check_size_every updates
+        if (self.updates - 1) % self.check_size_every == 0:
+            self.enforce_max_size()
+        return mirror
+
+    def clone(
+        self,
+        url: str,
+        target: Path,
+        branch: Optional[str] = None,
+        depth: Optional[int] = None,
+    ):
+        """clone url to target, hitting the network for what's new only,
+        the branch is checked out if specified"""
+        mirror = self.update(url, branch=branch, depth=depth)
+        clone_args = ["--single-branch", f"--branch={branch}"] if branch else []
+        # objects of a shallow mirror are copied instead of shared, there's a few of them
+        git.Git(target.parent).clone("--shared", *clone_args, str(mirror), str(target))
+        git.Git(target).remote("set-url", "origin", url)
+
+    def enforce_max_size(self):
+        """remove least recently used mirrors until the cache fits into max_size"""
+        mirrors = sorted(self.cache_dir.glob("*.git"), key=lambda m: m.stat().st_mtime)
+        sizes = {mirror: measure_tree(mirror)["total"] for mirror in mirrors}
+        total = sum(sizes.values())
+        for mirror in mirrors:
+            if total <= self.max_size:
+                break
+            if time.time() - mirror.stat().st_mtime < self.min_age:
+                continue
+            with self.locked(mirror, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                logger.info(f"Removing mirror {mirror}, cache is over its limit")
+                shutil.rmtree(mirror)
+                total -= sizes[mirror]
@@ -0,0 +1,81 @@
+import json
+import os
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+
+logger = getLogger(__name__)
+
+
+def read_records(path: Path, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Complete records of a JSON lines file from offset on and the offset after
+    the last one. A last line without its newline is still being written,
+    it's left for the next time, a record cut off by a crash is skipped.
+    """
+    records = []
+    with path.open("rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # not JSON, or not even UTF-8
+                logger.warning(f"{path}: skipping a corrupted record {line!r}")
+    return records, offset
+
+
+class JsonLinesJournal:
+    """Append-only file with one JSON record per line.
+
+    Records are flushed right away and fsync'd in batches of `fsync_every`,
+    so a crash loses at most the last batch and never the records before it.
+    """
+
+    def __init__(self, path: Path, fsync_every: int = 1):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.file: Optional[TextIO] = None
+        self.unsynced = 0
+
+    def replay(self) -> List[Dict[str, Any]]:
+        """records stored in the journal, without a record cut off by a crash"""
+        if not self.path.is_file():
+            return []
+        return read_records(self.path)[0]
+
+    def ends_with_newline(self) -> bool:
+        with self.path.open("rb") as journal:
+            journal.seek(-1, os.SEEK_END)
+            return journal.read(1) == b"\n"
+
+    def append(self, record: Dict[str, Any]):
+        if self.file is None:
+            self.file = self.path.open("a")
+            if self.file.tell() and not self.ends_with_newline():
+                # don't glue the new record to a half-written one
+                self.file.write("\n")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if self.path.exists():
+            self.path.unlink()
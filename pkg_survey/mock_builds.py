@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from stage_metrics import run_child
+
+logger = getLogger(__name__)
+
+
+class MockBuildManager:
+    """
+    Mock builds of SRPMs with their outcomes remembered.
+
+    An SRPM with the same content as one built less than `ttl` seconds ago
+    isn't built again, the outcome of the previous build is used instead.
+    Builds keep their logs until their outcome expires, buildroots are created
+    from mock's root cache and packages are installed from its package cache,
+    both shared by all the (--uniqueext) roots of the chroot.
+    """
+
+    def __init__(
+        self, cache_dir: Path, chroot: str, ttl: int, remove_expired_every: int = 20
+    ):
+        self.cache_dir = cache_dir
+        self.chroot = chroot
+        self.ttl = ttl
+        self.remove_expired_every = remove_expired_every
+        self.builds = 0
+
+    def srpm_digest(self, srpm_path: Path) -> str:
+        """
+        Digest of what's in the SRPM, SRPMs created from the same sources
+        at different times differ in the build time, but not in this
+        """
+        content = subprocess.run(
+            [
+                "rpm",
+                "-qp",
+                "--nosignature",
+                "--qf",
+                "%{NEVR}\n[%{FILENAMES} %{FILEDIGESTS}\n]",
+                str(srpm_path),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        return sha256(self.chroot.encode() + b"\n" + content).hexdigest()
+
+    def cached_outcome(self, build_dir: Path) -> Optional[Dict[str, Any]]:
+        outcome_path = build_dir / "outcome.json"
+        if not outcome_path.is_file():
+            return None
+        outcome = json.loads(outcome_path.read_text())
+        if time.time() - outcome["time"] >= self.ttl:
+            return None
+        return outcome
+
+    def remove_expired(self):
+        """remove builds with expired outcomes and what crashed processes left behind"""
+        now = time.time()
+        for path in self.cache_dir.glob("*"):
+            unfinished = path.suffix in (".tmp", ".trash")
+            try:
+                written = (
+                    (path if unfinished else path / "outcome.json").stat().st_mtime
+                )
+            except OSError:
+                # removed by another process, or not a build
+                continue
+            if now - written < self.ttl:
+                continue
+            if not unfinished:
+                # out of the way first, a half-removed build would be a hit
+                trash = path.with_name(f"{path.name}.{os.getpid()}.trash")
+                try:
+                    os.rename(path, trash)
+                except OSError:
+                    continue
+                path = trash
+            shutil.rmtree(path, ignore_errors=True)
+
+    def build(self, srpm_path: Path, uniqueext: Optional[str] = None) -> Dict[str, Any]:
+        """
+        :return: success (bool), duration of the build, directory with its logs
+                 and whether the outcome was taken from the cache
+        """
+        self.builds += 1
+        # on the first build of a run and then every remove_expired_every builds
+        if (self.builds - 1) % self.remove_expired_every == 0:
+            self.remove_expired()
+        build_dir = self.cache_dir / self.srpm_digest(srpm_path)
+        outcome = self.cached_outcome(build_dir)
+        if outcome:
+            logger.info(
+                f"Outcome of the build of {srpm_path.name} taken from the cache."
+            )
+            return {**outcome, "cached": True}
+
+        result_dir = build_dir.with_name(f"{build_dir.name}.{os.getpid()}.tmp")
+        if result_dir.is_dir():
+            shutil.rmtree(result_dir)
+        result_dir.mkdir(parents=True)
+        cmd = [
+            "mock",
+            "-r",
+            self.chroot,
+            "rebuild",
+            str(srpm_path),
+            f"--resultdir={result_dir}",
+            # the cached buildroot is created again once mock's config changes
+            # (root_cache's age_check), it's updated with the packages of the build anyway
+            "--enable-plugin=root_cache",
+            "--enable-plugin=yum_cache",
+        ]
+        if uniqueext:
+            cmd.append(f"--uniqueext={uniqueext}")
+        start = time.monotonic()
+        # mock is what takes most of the memory of the build stage
+        returncode = run_child(cmd)
+        outcome = {
+            "success": not returncode,
+            "duration": round(time.monotonic() - start),
+            "logs": str(build_dir),
+            "time": time.time(),
+        }
+        # the built packages are not needed, logs are
+        for rpm in result_dir.glob("*.rpm"):
+            rpm.unlink()
+        (result_dir / "outcome.json").write_text(json.dumps(outcome))
+        if build_dir.is_dir():
+            # expired outcome
+            shutil.rmtree(build_dir, ignore_errors=True)
+        try:
+            os.rename(result_dir, build_dir)
+        except OSError:
+            # built by another process in the meantime
+            shutil.rmtree(result_dir)
+        return {**outcome, "cached": False}
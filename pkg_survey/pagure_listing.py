@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Any, Dict, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = getLogger(__name__)
+
+
+class PagureListing:
+    """
+    Client of the paginated listings of the Pagure API.
+
+    Connections are kept alive and reused, failed requests are retried
+    with an exponential backoff. The next page is downloaded
+    while the projects of the current one are being processed.
+    """
+
+    def __init__(self, per_page: int = 100, retries: int = 5, backoff: float = 1.0):
+        self.per_page = per_page
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+            )
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def first_page(self, url: str) -> str:
+        """url with per_page, the next pages keep it"""
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        params = dict(parse_qsl(query))
+        params.setdefault("per_page", str(self.per_page))
+        return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+    def get_page(self, url: str) -> Dict[str, Any]:
+        logger.info(url)
+        response = self.session.get(url, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def projects(self, url: str) -> Iterator[Dict[str, Any]]:
+        """yield projects of the listing starting at url, page after page"""
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            page = prefetcher.submit(self.get_page, self.first_page(url))
+            while page:
+                content = page.result()
+                next_url = content["pagination"]["next"]
+                page = prefetcher.submit(self.get_page, next_url) if next_url else None
+                yield from content["projects"]
@@ -0,0 +1,44 @@
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+import yaml
+
+from json_lines import JsonLinesJournal
+
+
+class ResultSink:
+    """
+    Results of processed packages, appended to a file as one JSON line per package.
+
+    Every record is flushed and fsync'd right away, so a crash loses at most
+    the packages being processed at that moment. A record with nothing but
+    package_name marks a package which was processed without producing any result.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.journal = JsonLinesJournal(path)
+        # records appended from several threads must not interleave
+        self.lock = threading.Lock()
+
+    def append(self, result: Dict[str, Any]):
+        with self.lock:
+            self.journal.append(result)
+
+    def records(self) -> List[Dict[str, Any]]:
+        return self.journal.replay()
+
+    def recorded_packages(self) -> Set[str]:
+        """packages which don't need to be processed again when resuming"""
+        return {record.get("package_name") for record in self.records()}
+
+    def export_yaml(self, path: Path):
+        dump_yaml(self.records(), path)
+
+
+def dump_yaml(records: List[Dict[str, Any]], path: Path):
+    """dump results to a YAML list, the layout the result files always had"""
+    results = [record for record in records if set(record) != {"package_name"}]
+    with path.open("w") as outfile:
+        yaml.dump(results, outfile)
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""
+Query survey/onboarding results and packages.json through an SQLite index.
+
+Files are loaded into the database (results.sqlite next to this script)
+on every invocation, but only those which changed since the last one,
+results appended to a .jsonl file are loaded from where the last load stopped.
+
+Tables:
+    results(source, package, error_class, error, data)
+        data: the whole result as JSON, use json_extract(data, '$.size')
+        error_class: CloneError, ConvertError, SRPMError, MockBuildError,
+                     SpecfileNotFound, Other or NULL
+    branches(source, stream, package, branch, branch_prefix)
+        stream: c8 (c8s-only projects) or c9 (projects with c9s) of packages.json
+        branch_prefix: c8s-stream for c8s-stream-rhel8, c8s for c8s
+
+    ./results_db.py packages --stream c9 --branch-prefix c8s-stream --error-class ConvertError
+    ./results_db.py errors
+    ./results_db.py sql "SELECT package FROM results WHERE json_extract(data, '$.autosetup')"
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import yaml
+
+from json_lines import read_records
+
+root = Path(__file__).resolve().parent.parent
+default_db = Path(__file__).resolve().parent / "results.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, loaded INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    source TEXT, package TEXT, error_class TEXT, error TEXT, data TEXT
+);
+CREATE INDEX IF NOT EXISTS results_package ON results (package);
+CREATE INDEX IF NOT EXISTS results_error_class ON results (error_class, package);
+CREATE INDEX IF NOT EXISTS results_source ON results (source);
+CREATE TABLE IF NOT EXISTS branches (
+    source TEXT, stream TEXT, package TEXT, branch TEXT, branch_prefix TEXT
+);
+CREATE INDEX IF NOT EXISTS branches_package ON branches (package);
+CREATE INDEX IF NOT EXISTS branches_prefix ON branches (branch_prefix, stream, package);
+CREATE INDEX IF NOT EXISTS branches_source ON branches (source);
+"""
+
+
+def error_class(error: Any) -> Optional[str]:
+    if not error:
+        return None
+    error = str(error)
+    match = re.match(r"(\w+Error):", error)
+    if match:
+        return match.group(1)
+    if error.startswith("mock build failed"):
+        return "MockBuildError"
+    if error.startswith("Specfile not found"):
+        return "SpecfileNotFound"
+    return "Other"
+
+
+def branch_prefix(branch: str) -> str:
+    """c8s-stream-rhel8 -> c8s-stream, c9s-20200602 -> c9s"""
+    parts = branch.split("-")
+    return "-".join(parts[:2]) if len(parts) > 2 else parts[0]
+
+
+def default_sources() -> List[Path]:
+    """result files of the survey and the onboarding and packages.json,
+    YAML exports of .jsonl results are skipped"""
+    candidates = sorted(root.glob("pkg_survey/result*.jsonl"))
+    candidates += sorted(root.glob("onboard/input/result*.jsonl"))
+    jsonl_stems = {(path.parent, path.stem) for path in candidates}
+    candidates += [
+        path
+        for path in sorted(root.glob("pkg_survey/result*.yml"))
+        + sorted(root.glob("onboard/input/result*.yml"))
+        if (path.parent, path.stem) not in jsonl_stems
+    ]
+    candidates.append(root / "packages.json")
+    return [path for path in candidates if path.is_file()]
+
+
+class ResultsDB:
+    def __init__(self, path: Path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.executescript(SCHEMA)
+
+    def forget(self, source: str):
+        for table in ("results", "branches", "sources"):
+            self.connection.execute(f"DELETE FROM {table} WHERE source = ?", (source,))
+
+    def insert_results(self, source: str, results: Iterable[Dict[str, Any]]):
+        self.connection.executemany(
+            "INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    source,
+                    result.get("package_name"),
+                    error_class(result.get("error")),
+                    result.get("error"),
+                    json.dumps(result, default=str),
+                )
+                for result in results
+            ),
+        )
+
+    def insert_branches(self, source: str, packages: Dict[str, Dict[str, List[str]]]):
+        self.connection.executemany(
+            "INSERT INTO branches VALUES (?, ?, ?, ?, ?)",
+            (
+                (source, stream, package, branch, branch_prefix(branch))
+                for stream in ("c8", "c9")
+                for package, branches in packages.get(stream, {}).items()
+                for branch in branches
+            ),
+        )
+
+    def load(self, path: Path) -> bool:
+        """(re)load the file if it changed, True if it did"""
+        source = str(path.resolve())
+        stat = path.stat()
+        previous: Optional[Tuple[int, int, int]] = self.connection.execute(
+            "SELECT mtime_ns, size, loaded FROM sources WHERE source = ?", (source,)
+        ).fetchone()
+        if previous and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+            return False
+
+        with self.connection:
+            loaded = 0
+            if path.suffix == ".jsonl" and previous and previous[2] <= stat.st_size:
+                # results are only appended
+                loaded = previous[2]
+            else:
+                self.forget(source)
+            if path.suffix == ".jsonl":
+                results, loaded = read_records(path, loaded)
+                self.insert_results(source, results)
+            elif path.suffix == ".yml":
+                with path.open() as f:
+                    self.insert_results(
+                        source,
+                        yaml.load(
+                            f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+                        )
+                        or [],
+                    )
+                loaded = stat.st_size
+            else:
+                self.insert_branches(source, json.loads(path.read_text()))
+                loaded = stat.st_size
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (source, stat.st_mtime_ns, stat.st_size, loaded),
+            )
+        return True
+
+    def query(self, sql: str, parameters: Iterable[Any] = ()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, tuple(parameters))
+
+
+def packages_query(args: argparse.Namespace) -> Tuple[str, List[Any]]:
+    joins, conditions, parameters = [], [], []
+    if args.stream or args.branch_prefix:
+        joins.append("JOIN branches b ON b.package = r.package")
+    if args.stream:
+        conditions.append("b.stream = ?")
+        parameters.append(args.stream)
+    if args.branch_prefix:
+        conditions.append("b.branch_prefix = ?")
+        parameters.append(args.branch_prefix)
+    if args.error_class:
+        conditions.append("r.error_class = ?")
+        parameters.append(args.error_class)
+    if args.failed:
+        conditions.append("r.error IS NOT NULL")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return (
+        f"SELECT DISTINCT r.package, r.error_class, r.error FROM results r "
+        f"{' '.join(joins)} {where} ORDER BY r.package",
+        parameters,
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", type=Path, default=default_db)
+    parser.add_argument(
+        "--load",
+        type=Path,
+        action="append",
+        help="result files (.yml, .jsonl) or packages.json to query, "
+        "result files of this repo by default",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    packages = commands.add_parser(
+        "packages", help="results of packages matching all filters"
+    )
+    packages.add_argument("--stream", choices=("c8", "c9"))
+    packages.add_argument("--branch-prefix")
+    packages.add_argument("--error-class")
+    packages.add_argument("--failed", action="store_true")
+    commands.add_parser("errors", help="number of packages per source and error class")
+    sql = commands.add_parser("sql", help="run an SQL query")
+    sql.add_argument("query")
+    args = parser.parse_args(argv)
+
+    db = ResultsDB(args.db)
+    start = time.monotonic()
+    for path in args.load or default_sources():
+        if db.load(path):
+            print(f"Loaded {path} in {time.monotonic() - start:.2f}s", file=sys.stderr)
+            start = time.monotonic()
+
+    start = time.monotonic()
+    if args.command == "packages":
+        cursor = db.query(*packages_query(args))
+    elif args.command == "errors":
+        cursor = db.query(
+            "SELECT source, error_class, COUNT(DISTINCT package) FROM results "
+            "GROUP BY source, error_class ORDER BY source, 3 DESC"
+        )
+    else:
+        cursor = db.query(args.query)
+    rows = cursor.fetchall()
+    print("\t".join(column[0] for column in cursor.description or ()))
+    for row in rows:
+        print(
+            "\t".join(
+                "" if value is None else str(value).replace("\n", "\\n")
+                for value in row
+            )
+        )
+    print(
+        f"{len(rows)} rows in {(time.monotonic() - start) * 1000:.1f}ms",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import re
+from typing import Any, Dict, List
+
+# sections start at the beginning of a line, %prep is followed by one of these
+PREP_END = re.compile(r"\n%(?:build|install|check|files|changelog)\b")
+# runs of consecutive Patch tags, which are in the preamble, a match per run
+PATCH_TAG = r"[ \t]*patch\d*[ \t]*:[^\n]*"
+PATCH_TAGS = re.compile(rf"\n{PATCH_TAG}(?:\n{PATCH_TAG})*", re.IGNORECASE)
+FIRST_PATCH_TAG = re.compile(PATCH_TAG, re.IGNORECASE)
+# lines of %prep the analysis cares about, a match per line: conditionals and (auto)setup
+# with their continuation lines, and runs of consecutive %patch lines,
+# the regex engine skips the other lines without creating a string for each of them
+PREP_LINES = re.compile(
+    r"\n[ \t]*(?:"
+    r"(%(?:if|el|endif|autosetup|setup)\w*)([^\n]*(?:(?<=\\)\n[^\n]*)*)"
+    r"|(%patch[^\n]*(?:\n[ \t]*%patch[^\n]*)*)"
+    r")"
+)
+CONDITIONAL_START = re.compile(r"%if(n?arch|n?os)?$")
+CONDITIONAL_ELIF = re.compile(r"%elif(n?arch|n?os)?$")
+
+
+def current_condition(branches: List[str]) -> str:
+    """condition of the last branch of a conditional: previous ones didn't match
+    and the last one did (an empty one is %else)"""
+    *previous, last = branches
+    conditions = [f"!({condition})" for condition in previous if condition]
+    if last:
+        conditions.append(last)
+    return " && ".join(conditions)
+
+
+def analyze_spec(spec_cont: str) -> Dict[str, Any]:
+    """
+    Go through the preamble and %prep of a spec file line by line and report:
+
+    * autosetup, setup: whether %autosetup, %setup is used
+    * conditional_patch: conditions under which a %patch is applied, nested
+      conditionals are joined with ' && ', one entry per distinct condition,
+      %if X is represented just by X, other conditionals by the whole directive
+    * patch_count: number of Patch tags
+    * applied_patch_count: number of %patch lines
+    """
+    # for every open conditional: conditions of its previous branches and of the current one
+    stack: List[List[str]] = []
+    result: Dict[str, Any] = {
+        "autosetup": False,
+        "setup": False,
+        "conditional_patch": [],
+        "patch_count": 0,
+        "applied_patch_count": 0,
+    }
+    prep = spec_cont.find("\n%prep")
+    if prep < 0:
+        prep = prep_end = len(spec_cont)
+    else:
+        section = PREP_END.search(spec_cont, prep)
+        prep_end = section.start() if section else len(spec_cont)
+
+    # every line of a run starts with a newline, but the first line of the file
+    if FIRST_PATCH_TAG.match(spec_cont):
+        result["patch_count"] += 1
+    for patch_tags in PATCH_TAGS.findall(spec_cont, 0, prep):
+        result["patch_count"] += patch_tags.count("\n")
+
+    for keyword, rest, patches in PREP_LINES.findall(spec_cont, prep, prep_end):
+        if patches:
+            result["applied_patch_count"] += patches.count("\n") + 1
+            if stack:
+                path = " && ".join(current_condition(branches) for branches in stack)
+                if path not in result["conditional_patch"]:
+                    result["conditional_patch"].append(path)
+        elif keyword == "%autosetup":
+            result["autosetup"] = True
+        elif keyword == "%setup":
+            result["setup"] = True
+        elif CONDITIONAL_START.match(keyword):
+            condition = " ".join(rest.replace("\\\n", " ").split())
+            stack.append([condition if keyword == "%if" else f"{keyword} {condition}"])
+        elif CONDITIONAL_ELIF.match(keyword):
+            if stack:
+                condition = " ".join(rest.replace("\\\n", " ").split())
+                stack[-1].append(
+                    condition if keyword == "%elif" else f"{keyword} {condition}"
+                )
+        elif keyword == "%else":
+            if stack:
+                stack[-1].append("")
+        elif keyword == "%endif":
+            if stack:
+                stack.pop()
+    return result
@@ -0,0 +1,190 @@
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+from result_sink import ResultSink
+
+# resources used by a stage of processing a package:
+# wall: seconds, cpu: seconds of the thread and of the finished child processes,
+# max_rss: peak resident memory of the process or of the largest child
+#          it waited for during the stage (kB),
+# transferred: bytes received and sent over the network interfaces
+Stages = Dict[str, Dict[str, float]]
+
+# the high-water mark of the process is reset only when no other stage is being measured
+measuring_lock = threading.Lock()
+measuring = 0
+# peak memory of the children run by run_child, for every stage the thread is measuring
+measured_children = threading.local()
+
+
+def cpu_time() -> float:
+    own = resource.getrusage(resource.RUSAGE_THREAD)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def reset_max_rss():
+    """reset the high-water mark of the resident memory of the process (Linux >= 4.0)"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def max_rss() -> int:
+    """high-water mark of the resident memory of the process since its last reset (kB)"""
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def children_max_rss() -> int:
+    """peak resident memory of the largest child ever waited for (kB)"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+def run_child(cmd: List[str]) -> int:
+    """
+    Run the command and return its exit code. Its peak memory (of its children
+    included) is attributed to the stages the thread is measuring.
+    """
+    process = subprocess.Popen(cmd)
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    # reaped already, Popen must not wait for it
+    process.returncode = (
+        -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    )
+    peaks = getattr(measured_children, "peaks", [])
+    for index, peak in enumerate(peaks):
+        peaks[index] = max(peak, usage.ru_maxrss)
+    return process.returncode
+
+
+def network_bytes() -> int:
+    """bytes received and sent by all the interfaces but loopback, 0 if unknown"""
+    try:
+        lines = Path("/proc/net/dev").read_text().splitlines()[2:]
+    except OSError:
+        return 0
+    total = 0
+    for line in lines:
+        interface, counters = line.split(":", 1)
+        if interface.strip() == "lo":
+            continue
+        fields = counters.split()
+        total += int(fields[0]) + int(fields[8])
+    return total
+
+
+@contextmanager
+def measure(stages: Stages, stage: str) -> Iterator[None]:
+    """
+    Record resources used by the block as the stage.
+
+    CPU time of child processes, peak memory of the process and of children
+    which are not run by run_child, and network traffic can't be told apart
+    when packages are processed concurrently (by threads), they're
+    attributed to the stages which were running at the time.
+    """
+    global measuring
+    with measuring_lock:
+        if not measuring:
+            reset_max_rss()
+        measuring += 1
+    if not hasattr(measured_children, "peaks"):
+        measured_children.peaks = []
+    measured_children.peaks.append(0)
+    start_wall = time.monotonic()
+    start_cpu = cpu_time()
+    start_children_rss = children_max_rss()
+    start_net = network_bytes()
+    try:
+        yield
+    finally:
+        children_rss = measured_children.peaks.pop()
+        # children waited for by others (e.g. git run by GitPython) are known
+        # only when one of them is the largest so far
+        end_children_rss = children_max_rss()
+        if end_children_rss > start_children_rss:
+            children_rss = max(children_rss, end_children_rss)
+        with measuring_lock:
+            process_rss = max_rss()
+            measuring -= 1
+        stages[stage] = {
+            "wall": round(time.monotonic() - start_wall, 3),
+            "cpu": round(cpu_time() - start_cpu, 3),
+            "max_rss": max(process_rss, children_rss),
+            "transferred": network_bytes() - start_net,
+        }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, round(fraction * len(ordered)) - 1)]
+
+
+def report(records: List[Dict[str, Any]], slowest: int = 10) -> str:
+    """p50/p95 of the stages and the slowest packages of the results"""
+    timed = [record for record in records if record.get("stages")]
+    per_stage: Dict[str, List[Dict[str, float]]] = {}
+    for record in timed:
+        for stage, usage in record["stages"].items():
+            per_stage.setdefault(stage, []).append(usage)
+
+    lines = [
+        f"{'stage':<10} {'count':>6} {'wall p50':>9} {'wall p95':>9} "
+        f"{'cpu p50':>8} {'cpu p95':>8} {'rss p95 [MB]':>12} {'MB p95':>7}"
+    ]
+    for stage, usages in per_stage.items():
+
+        def p(key: str, fraction: float) -> float:
+            return percentile([usage[key] for usage in usages], fraction)
+
+        lines.append(
+            f"{stage:<10} {len(usages):>6} {p('wall', 0.5):>9.1f} {p('wall', 0.95):>9.1f} "
+            f"{p('cpu', 0.5):>8.1f} {p('cpu', 0.95):>8.1f} "
+            f"{p('max_rss', 0.95) / 1024:>12.0f} {p('transferred', 0.95) / 1024**2:>7.1f}"
+        )
+
+    def total_wall(record: Dict[str, Any]) -> float:
+        return sum(usage["wall"] for usage in record["stages"].values())
+
+    lines.append("slowest packages:")
+    for record in sorted(timed, key=total_wall, reverse=True)[:slowest]:
+        stages = ", ".join(
+            f"{stage} {usage['wall']:.0f}s" for stage, usage in record["stages"].items()
+        )
+        lines.append(
+            f"  {record.get('package_name')}: {total_wall(record):.0f}s ({stages})"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python3 stage_metrics.py result-data.jsonl [...]
+    print(
+        report(
+            [
+                record
+                for path in sys.argv[1:]
+                for record in ResultSink(Path(path)).records()
+            ]
+        )
+    )
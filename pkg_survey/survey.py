@@ -1,70 +1,147 @@
-import re
+import os
 import shutil
 import subprocess
+from functools import lru_cache
 from logging import getLogger
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, Iterable, List, TYPE_CHECKING
 
 import git
-import requests
-import yaml
-from click.testing import CliRunner
-from dist2src.core import Dist2Src
 
-from packit.cli.utils import get_packit_api
-from packit.config import Config
-from packit.local_project import LocalProject
+from conversion_cache import ConversionCache
+from dir_size import measure_tree
+from git_mirror import GitMirrorCache
+from mock_builds import MockBuildManager
+from pagure_listing import PagureListing
+from result_sink import ResultSink
+from spec_analyzer import analyze_spec
+from stage_metrics import Stages, measure, report
+from work_queue import WorkQueue
+from workspaces import Workspaces
+
+if TYPE_CHECKING:
+    # dist2src and packit are imported when a package is converted, they take a while
+    from dist2src.core import Dist2Src
+    from packit.api import PackitAPI
+    from packit.config import Config
 
 logger = getLogger(__name__)
 
 work_dir = Path("/tmp/playground")
-rpms_dir = work_dir / "rpms"
-src_dir = work_dir / "src"
-result = []
-packit_conf = Config.get_user_config()
-runner = CliRunner()
+# persistent data reused by the next runs
+cache_dir = Path(os.getenv("CACHE_DIR", work_dir / "cache"))
+mirror_cache = GitMirrorCache(
+    cache_dir / "mirrors",
+    max_size=int(float(os.getenv("GIT_MIRROR_MAX_GB", "20")) * 1024**3),
+)
+conversion_cache = ConversionCache(
+    cache_dir / "conversions",
+    tool="dist2src",
+    max_size=int(float(os.getenv("CONVERSION_CACHE_MAX_GB", "20")) * 1024**3),
+)
+mock_builds = MockBuildManager(
+    cache_dir / "mock-builds",
+    chroot="centos-stream-x86_64",
+    # buildroots change, so a build outcome goes stale, a week by default
+    ttl=int(os.getenv("MOCK_RESULT_TTL", str(7 * 24 * 3600))),
+)
+# history of dist-git repos is not needed for the conversion, 0 = whole history
+distgit_clone_depth = int(os.getenv("DISTGIT_CLONE_DEPTH", "1"))
+listing = PagureListing(per_page=int(os.getenv("PAGURE_PER_PAGE", "100")))
+# every package is processed in a directory of its own
+workspaces = Workspaces(
+    work_dir / "workspaces",
+    max_size=int(float(os.getenv("WORKSPACE_MAX_GB", "50")) * 1024**3),
+)
 
 BRANCH = "c8s"
+# number of processes surveying packages in parallel, 1 = sequential survey
+survey_workers = int(os.getenv("SURVEY_WORKERS", "1"))
+# packages shared with workers on other hosts, see work_queue.py
+work_queue_path = os.getenv("WORK_QUEUE")
+# lost leases (of crashed workers) go back to the queue after this many seconds
+lease_ttl = int(os.getenv("LEASE_TTL", "600"))
+# continue an interrupted survey instead of starting from scratch
+resume = bool(os.getenv("RESUME"))
+# mock root of a worker process of the parallel survey
+worker_mock_uniqueext: Optional[str] = None
+
+
+@lru_cache(maxsize=None)
+def packit_config() -> "Config":
+    from packit.config import Config
+
+    return Config.get_user_config()
+
+
+def dist2src(dist_git_path: Path, source_git_path: Path) -> "Dist2Src":
+    from dist2src.core import Dist2Src
+
+    return Dist2Src(dist_git_path=dist_git_path, source_git_path=source_git_path)
+
+
+def packit_api(project_path: Path) -> "PackitAPI":
+    from packit.cli.utils import get_packit_api
+    from packit.local_project import LocalProject
+
+    return get_packit_api(
+        config=packit_config(), local_project=LocalProject(git.Repo(project_path))
+    )
 
 
 class CentosPkgValidatedConvert:
-    def __init__(self, package_name: str, distgit_branch: str):
+    def __init__(
+        self,
+        package_name: str,
+        distgit_branch: str,
+        workspace: Optional[Path] = None,
+        mock_uniqueext: Optional[str] = None,
+    ):
+        # a scratch directory of its own, unless told otherwise
+        self.owns_workspace = workspace is None
+        self.workspace = workspace or workspaces.acquire(package_name)
         self.package_name = package_name
-        self.rpm_package_dir: Path = rpms_dir / package_name
-        self.src_package_dir: Path = src_dir / package_name
+        self.rpm_package_dir: Path = self.workspace / "rpms" / package_name
+        self.src_package_dir: Path = self.workspace / "src" / package_name
+        # mock needs a separate root for every concurrent build
+        self.mock_uniqueext = mock_uniqueext
         self.result: Dict[str, Any] = {}
+        # resources used by the stages of processing the package
+        self.stages: Stages = {}
         self.srpm_path = ""
         self.distgit_branch = distgit_branch
-        self.d2s: Optional[Dist2Src] = None
+        self.d2s: Optional["Dist2Src"] = None
 
-    def clone(self, git_url: str, dir: Path) -> bool:
+    def clone(self, git_url: str, dir: Path, depth: Optional[int] = None) -> bool:
         try:
-            git.Git(dir).clone(git_url)
-            r = git.Repo(dir / self.package_name)
-            r.git.checkout(self.distgit_branch)
+            commit = mirror_cache.remote_branch_commit(git_url, self.distgit_branch)
+            if not commit:
+                return False
+            workspaces.populate(
+                dir / self.package_name,
+                key=f"{git_url} {self.distgit_branch} {commit} {depth}",
+                create=lambda target: mirror_cache.clone(
+                    git_url, target, branch=self.distgit_branch, depth=depth
+                ),
+            )
             return True
         except Exception as ex:
-            if f"Remote branch {self.distgit_branch} not found" in str(
-                ex
-            ) or f"pathspec '{self.distgit_branch}' did not match" in str(ex):
-                return False
             self.result["package_name"] = self.package_name
             self.result["error"] = f"CloneError: {ex}"
             return False
 
     def run_srpm(self):
         try:
-            packit_api = get_packit_api(
-                config=packit_conf,
-                local_project=LocalProject(git.Repo(self.src_package_dir)),
+            self.srpm_path = packit_api(self.src_package_dir).create_srpm(
+                srpm_dir=self.src_package_dir
             )
-            self.srpm_path = packit_api.create_srpm(srpm_dir=self.src_package_dir)
         except Exception as e:
             self.result["error"] = f"SRPMError: {e}"
 
     def convert(self) -> bool:
         try:
-            self.d2s = Dist2Src(
+            self.d2s = dist2src(
                 dist_git_path=self.rpm_package_dir,
                 source_git_path=self.src_package_dir,
             )
@@ -75,109 +152,270 @@ class CentosPkgValidatedConvert:
             return False
 
     def cleanup(self):
+        if self.owns_workspace:
+            # removed in the background
+            workspaces.release(self.workspace)
+            return
         if self.rpm_package_dir.is_dir():
             shutil.rmtree(self.rpm_package_dir)
         if self.src_package_dir.is_dir():
             shutil.rmtree(self.src_package_dir)
 
     def do_mock_build(self):
-        c = subprocess.run(
-            ["mock", "-r", "centos-stream-x86_64", "rebuild", self.srpm_path]
+        with measure(self.stages, "build"):
+            try:
+                outcome = mock_builds.build(
+                    Path(self.srpm_path), uniqueext=self.mock_uniqueext
+                )
+            except subprocess.CalledProcessError as ex:
+                # mock couldn't build it either
+                reason = f"rpm can't read the SRPM (exit status {ex.returncode})"
+                self.result["error"] = f"mock build failed, {reason}"
+                return
+        self.result.update(
+            {
+                "build_cache": "hit" if outcome["cached"] else "miss",
+                "build_duration": outcome["duration"],
+                "build_logs": outcome["logs"],
+            }
         )
-        if not c.returncode:
+        if outcome["success"]:
             return
-        self.result["error"] = "mock build failed"
-
-    @staticmethod
-    def get_conditional_info(spec_cont) -> List[str]:
-        conditions = re.findall(r"\n%if.*?\n%endif", spec_cont, re.DOTALL)
-        result = []
-        p = re.compile("\n%if (.*)\n")
-        for con in conditions:
-            if "\n%patch" in con:
-                found = p.search(con)
-                if found:
-                    result.append(found.group(1))
-        return result
+        self.result["error"] = f"mock build failed. More info in: {outcome['logs']}"
 
-    def run(
-        self, cleanup: bool = False, skip_build: bool = False, clone_sg: bool = False
-    ):
-        if not self.clone(
-            git_url=f"https://git.centos.org/rpms/{self.package_name}", dir=rpms_dir
-        ):
-            return
-        if clone_sg:
-            self.clone(
-                git_url=f"https://git.stg.centos.org/source-git/{self.package_name}",
-                dir=src_dir,
-            )
+    def fetch(self, clone_sg: bool = False) -> bool:
+        """clone the dist-git (and the source-git) repo, False if there's nothing to convert"""
+        with measure(self.stages, "clone"):
+            if not self.clone(
+                git_url=f"https://git.centos.org/rpms/{self.package_name}",
+                dir=self.rpm_package_dir.parent,
+                depth=distgit_clone_depth,
+            ):
+                return False
+            if clone_sg:
+                self.clone(
+                    git_url=f"https://git.stg.centos.org/source-git/{self.package_name}",
+                    dir=self.src_package_dir.parent,
+                )
+            return True
 
+    def process(self) -> bool:
+        """analyze the spec file, convert the package and create the SRPM,
+        True if there's an SRPM to build"""
         self.result["package_name"] = self.package_name
         specfile_path = self.rpm_package_dir / "SPECS" / f"{self.package_name}.spec"
         if not specfile_path.is_file():
             self.result["error"] = "Specfile not found."
             self.cleanup()
-            return
+            return False
+
+        # the source-git repo is there when updating, the conversion goes on top of it
+        sourcegit_commit = (
+            git.Repo(self.src_package_dir).head.commit.hexsha
+            if (self.src_package_dir / ".git").is_dir()
+            else None
+        )
+        cache_entry = conversion_cache.entry_path(
+            distgit_commit=git.Repo(self.rpm_package_dir).head.commit.hexsha,
+            sourcegit_commit=sourcegit_commit,
+            branch=self.distgit_branch,
+        )
+        with measure(self.stages, "restore"):
+            if self.restore_conversion(cache_entry):
+                return True
 
-        with specfile_path.open() as spec:
-            spec_cont = spec.read()
+        with measure(self.stages, "spec"), specfile_path.open() as spec:
+            self.result.update(analyze_spec(spec.read()))
+
+        with measure(self.stages, "convert"):
+            converted = self.convert()
+        if converted:
+            with measure(self.stages, "srpm"):
+                self.run_srpm()
+            with measure(self.stages, "size"):
+                sizes = measure_tree(self.src_package_dir)
             self.result.update(
                 {
-                    "autosetup": bool(re.search(r"\n%autosetup", spec_cont)),
-                    "setup": bool(re.search(r"\n%setup", spec_cont)),
-                    "conditional_patch": self.get_conditional_info(spec_cont),
+                    "size": sizes["total"],
+                    "size_git": sizes["git"],
+                    "size_worktree": sizes["worktree"],
+                    "size_objects": sizes["objects"],
                 }
             )
+            if self.srpm_path:
+                try:
+                    conversion_cache.store(
+                        cache_entry,
+                        src_dir=self.src_package_dir,
+                        base_commit=sourcegit_commit,
+                        srpm_path=Path(self.srpm_path),
+                        result=self.result,
+                    )
+                except Exception as ex:
+                    logger.warning(f"Caching conversion of {self.package_name}: {ex}")
+            self.result["conversion_cache"] = "miss"
+            return bool(self.srpm_path)
+        self.result["conversion_cache"] = "miss"
+        with measure(self.stages, "size"):
+            self.result["size_rpms"] = measure_tree(self.rpm_package_dir)["total"]
+        return False
 
-        if self.convert():
-            self.run_srpm()
-            self.result["size"] = (
-                subprocess.check_output(["du", "-sh", self.src_package_dir])
-                .split()[0]
-                .decode("utf-8")
+    def restore_conversion(self, cache_entry: Path) -> bool:
+        """take the converted source-git repo and the SRPM from the cache, if they're there"""
+        try:
+            cached = conversion_cache.restore(
+                cache_entry, self.src_package_dir, self.distgit_branch
             )
-            if self.srpm_path and not skip_build:
+        except Exception as ex:
+            logger.warning(f"Restoring conversion of {self.package_name}: {ex}")
+            return False
+        if not cached:
+            return False
+        logger.info(f"Conversion of {self.package_name} taken from the cache.")
+        self.result.update(cached["result"])
+        self.result["conversion_cache"] = "hit"
+        self.srpm_path = cached["srpm"]
+        return True
+
+    def run(
+        self, cleanup: bool = False, skip_build: bool = False, clone_sg: bool = False
+    ):
+        try:
+            if self.fetch(clone_sg=clone_sg) and self.process() and not skip_build:
                 self.do_mock_build()
-        else:
-            self.result["size_rpms"] = (
-                subprocess.check_output(["du", "-sh", self.rpm_package_dir])
-                .split()[0]
-                .decode("utf-8")
-            )
-        if cleanup:
-            self.cleanup()
+        finally:
+            # the workspace is acquired by __init__, even if fetching fails
+            if cleanup:
+                self.cleanup()
+
+
+def iterate_centos_pkgs(page: str) -> Iterable[str]:
+    """yield names of projects from the paginated listing starting at the page"""
+    for p in listing.projects(page):
+        yield p["name"]
+
+
+def init_survey_worker():
+    """give every worker process its own mock root"""
+    global worker_mock_uniqueext
+    worker_mock_uniqueext = f"worker-{os.getpid()}"
+
+
+def survey_package(package_name: str) -> Dict[str, Any]:
+    logger.info(f"Processing package: {package_name}")
+    converter = CentosPkgValidatedConvert(
+        package_name, BRANCH, mock_uniqueext=worker_mock_uniqueext
+    )
+    converter.run(cleanup=True)
+    if converter.result:
+        converter.result["stages"] = converter.stages
+    return converter.result or {"package_name": package_name}
 
 
-def fetch_centos_pkgs_info(page: str):
-    i = 0
+def fetch_centos_pkgs_info(
+    page: str, sink: ResultSink, workers: int = 1, resume: bool = False
+):
+    """
+    Survey all packages from the paginated listing starting at the page
+    and record the results in the sink. When resuming, packages already
+    recorded in the sink (by an interrupted run) are skipped.
+
+    With more than one worker, packages are surveyed by a pool of processes,
+    results are streamed back in the order of the listing, so the result
+    is the same as the one of the sequential survey.
+    """
+    recorded = sink.recorded_packages() if resume else set()
+    if recorded:
+        logger.info(f"Resuming, {len(recorded)} packages recorded already.")
+    package_names = (p for p in iterate_centos_pkgs(page) if p not in recorded)
+
+    def collect(package_results: Iterable[Dict[str, Any]]):
+        for package_result in package_results:
+            logger.info(package_result)
+            sink.append(package_result)
+
+    if workers > 1:
+        with Pool(workers, initializer=init_survey_worker) as pool:
+            collect(pool.imap(survey_package, package_names))
+    else:
+        collect(map(survey_package, package_names))
+
+
+def survey_leased_packages(queue_path: Path) -> int:
+    """survey packages leased from the queue until there are none left,
+    return how many of them were surveyed by this process"""
+    queue = WorkQueue(queue_path, lease_ttl=lease_ttl)
+    surveyed = 0
     while True:
-        logger.info(page)
-        r = requests.get(page)
-        for p in r.json()["projects"]:
-            logger.info(f"Processing package: {p['name']}")
-            converter = CentosPkgValidatedConvert(p, BRANCH)
-            converter.run(cleanup=True)
-            if converter.result:
-                logger.info(converter.result)
-                result.append(converter.result)
-        page = r.json()["pagination"]["next"]
-        if not page:
-            break
-        i += 1
-        if not (i % 2):
-            with open("intermediate-result.yml", "w") as outfile:
-                yaml.dump(result, outfile)
+        lease = queue.lease()
+        if lease is None:
+            return surveyed
+        package_name, _ = lease
+        try:
+            result = survey_package(package_name)
+        except Exception:
+            logger.exception(f"Surveying {package_name} failed")
+            queue.release(package_name)
+            continue
+        logger.info(result)
+        queue.complete(package_name, result)
+        surveyed += 1
 
 
-if __name__ == "__main__":
+def survey_queue(queue: WorkQueue, page: str, workers: int = 1):
+    """
+    Survey packages together with workers on other hosts using the same queue,
+    every one of them queues the packages of the paginated listing starting
+    at the page, those queued already are skipped.
+    Every worker process leases packages one by one.
+    """
+    # listed before the queue is locked, the other hosts keep leasing meanwhile
+    names = list(iterate_centos_pkgs(page))
+    added = queue.add([(name, None) for name in names])
+    logger.info(f"Queued {added} packages.")
+    if workers > 1:
+        with Pool(workers, initializer=init_survey_worker) as pool:
+            surveyed = sum(pool.map(survey_leased_packages, [queue.path] * workers))
+    else:
+        surveyed = survey_leased_packages(queue.path)
+    logger.info(f"Surveyed {surveyed} packages, queue: {queue.status()}")
+
+
+def main(package_names: Optional[List[str]] = None):
+    """survey all the packages (or just the ones specified),
+    results go to result-data.jsonl and result-data.yml, with RESUME set,
+    packages which have a record in result-data.jsonl already are skipped,
+    with WORK_QUEUE set, the packages are shared with other hosts"""
     if not work_dir.is_dir():
         logger.warning("Your work_dir is missing.")
-    rpms_dir.mkdir(exist_ok=True)
-    src_dir.mkdir(exist_ok=True)
+    workspaces.reclaim_stale()
     Path("mock_error_builds").mkdir(exist_ok=True)
-    fetch_centos_pkgs_info(
-        "https://git.centos.org/api/0/projects?namespace=rpms&owner=centosrcm&short=true"
-    )
-    with open("result-data.yml", "w") as outfile:
-        yaml.dump(result, outfile)
+    page = "https://git.centos.org/api/0/projects?namespace=rpms&owner=centosrcm&short=true"
+    if work_queue_path and not package_names:
+        queue = WorkQueue(Path(work_queue_path), lease_ttl=lease_ttl)
+        survey_queue(queue, page, workers=survey_workers)
+        # results of all the hosts so far, complete once the last one is done
+        queue.export_yaml(Path("result-data.yml"))
+        records = queue.results()
+    else:
+        result_sink = ResultSink(Path("result-data.jsonl"))
+        if package_names:
+            for package_name in package_names:
+                result_sink.append(survey_package(package_name))
+        else:
+            if not resume and result_sink.path.exists():
+                # results of the previous survey would be exported together with these
+                result_sink.path.unlink()
+            fetch_centos_pkgs_info(
+                page, sink=result_sink, workers=survey_workers, resume=resume
+            )
+        result_sink.export_yaml(Path("result-data.yml"))
+        records = result_sink.records()
+    logger.info(f"Stages:\n{report(records)}")
+    # worker processes of the parallel survey are gone, their trash is still there
+    workspaces.reclaim_stale()
+    workspaces.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+"""
+Packages to be surveyed or onboarded by workers on several hosts.
+
+    ./work_queue.py status /shared/work-queue.sqlite
+    ./work_queue.py export /shared/work-queue.sqlite result.yml
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from result_sink import dump_yaml
+
+logger = getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    branch TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    done REAL,
+    result TEXT
+);
+"""
+
+
+class WorkQueue:
+    """
+    An SQLite database on a filesystem shared by the hosts (which needs working
+    POSIX locks, e.g. NFSv4, clocks of the hosts should be in sync).
+
+    A worker leases a package for lease_ttl seconds, a heartbeat thread renews
+    the leases of the process while it's working on them. Once processed,
+    the package is completed with its result. Leases of workers which are gone
+    expire and their packages are leased again, at most max_attempts times.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        lease_ttl: int = 600,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+    ):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        # how often an idle worker checks whether leases of others expired
+        self.poll_interval = poll_interval
+        self.pid: Optional[int] = None
+        with self.transaction() as db:
+            db.execute(SCHEMA)
+
+    @property
+    def owner(self) -> str:
+        """every process is a worker of its own, forked ones too"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """a connection per transaction, so that threads and processes don't share one"""
+        db = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def start_heartbeat(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(
+            target=self.heartbeat, name="lease-heartbeat", daemon=True
+        ).start()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.lease_ttl / 3)
+            try:
+                self.renew()
+            except sqlite3.Error as ex:
+                # the lease lasts a while, the next beat may get through
+                logger.warning(f"Renewing leases failed: {ex}")
+
+    def renew(self):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE packages SET expires = ? WHERE owner = ? AND state = 'leased'",
+                (time.time() + self.lease_ttl, self.owner),
+            )
+
+    def add(self, packages: Iterable[Tuple[str, Optional[str]]]) -> int:
+        """queue (package, branch) pairs, those queued already are skipped"""
+        with self.transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO packages (name, branch) VALUES (?, ?)", packages
+            )
+            return db.total_changes - before
+
+    def lease(self, wait: bool = True) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        (package, branch) leased by this process, None once there's nothing to do.
+
+        :param wait: while other workers hold leases, wait for them to either
+                     finish or let their leases expire, instead of returning None
+        """
+        while True:
+            now = time.time()
+            with self.transaction() as db:
+                row = db.execute(
+                    "SELECT name, branch FROM packages WHERE attempts < ? "
+                    "AND (state = 'pending' OR (state = 'leased' AND expires < ?)) "
+                    "ORDER BY rowid LIMIT 1",
+                    (self.max_attempts, now),
+                ).fetchone()
+                if row:
+                    db.execute(
+                        "UPDATE packages SET state = 'leased', owner = ?, expires = ?, "
+                        "attempts = attempts + 1 WHERE name = ?",
+                        (self.owner, now + self.lease_ttl, row[0]),
+                    )
+                else:
+                    leased = db.execute(
+                        "SELECT 1 FROM packages "
+                        "WHERE state = 'leased' AND expires >= ? AND attempts < ? LIMIT 1",
+                        (now, self.max_attempts),
+                    ).fetchone()
+            if row:
+                self.start_heartbeat()
+                return row[0], row[1]
+            if not wait or not leased:
+                return None
+            time.sleep(self.poll_interval)
+
+    def complete(self, package: str, result: Optional[Dict[str, Any]]):
+        """record the result, None if processing the package didn't produce one"""
+        with self.transaction() as db:
+            updated = db.execute(
+                "UPDATE packages SET state = 'done', owner = ?, done = ?, result = ? "
+                "WHERE name = ? AND state != 'done'",
+                (
+                    self.owner,
+                    time.time(),
+                    None if result is None else json.dumps(result),
+                    package,
+                ),
+            ).rowcount
+        if not updated:
+            logger.warning(f"{package} was completed by another worker already.")
+
+    def release(self, package: str):
+        """give the package back, e.g. when processing it failed unexpectedly"""
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE packages SET state = 'pending', owner = NULL "
+                "WHERE name = ? AND owner = ? AND state = 'leased'",
+                (package, self.owner),
+            )
+
+    def status(self) -> Dict[str, int]:
+        """number of packages per state, leases which expired too many times are abandoned"""
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT CASE WHEN attempts >= ? AND (state = 'pending' "
+                "OR (state = 'leased' AND expires < ?)) THEN 'abandoned' ELSE state END, "
+                "COUNT(*) FROM packages GROUP BY 1",
+                (self.max_attempts, time.time()),
+            ).fetchall()
+        return dict(rows)
+
+    def throughput(self, window: int = 3600) -> List[Tuple[str, int]]:
+        """packages completed by every worker in the last window seconds"""
+        with self.transaction() as db:
+            return db.execute(
+                "SELECT owner, COUNT(*) FROM packages "
+                "WHERE state = 'done' AND done >= ? GROUP BY owner ORDER BY owner",
+                (time.time() - window,),
+            ).fetchall()
+
+    def results(self) -> List[Dict[str, Any]]:
+        """results of all the hosts, in the order the packages were queued"""
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT result FROM packages WHERE result IS NOT NULL ORDER BY rowid"
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def export_yaml(self, path: Path):
+        dump_yaml(self.results(), path)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    status = commands.add_parser("status", help="progress and throughput of workers")
+    status.add_argument("queue", type=Path)
+    export = commands.add_parser("export", help="write results as a result file")
+    export.add_argument("queue", type=Path)
+    export.add_argument("output", type=Path)
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.queue)
+    if args.command == "export":
+        queue.export_yaml(args.output)
+        return
+    for state, count in sorted(queue.status().items()):
+        print(f"{state:<10} {count:>6}")
+    print("\npackages completed in the last hour:")
+    for owner, count in queue.throughput():
+        print(f"{owner:<30} {count:>6}")
+
+
+if __name__ == "__main__":
+    main()
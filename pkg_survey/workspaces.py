@@ -0,0 +1,275 @@
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Callable, Dict, Optional
+
+from dir_size import measure_tree
+
+logger = getLogger(__name__)
+
+# held by the process using the workspace, for as long as it's used
+LOCK_NAME = ".lock"
+# size of the tree of a base in bytes, measured when the base is created
+SIZE_NAME = "size"
+
+
+class Workspaces:
+    """
+    Scratch directories of packages being processed, one per package
+    (with rpms/ and src/ in it), so that packages never share a directory.
+
+    A workspace is locked (flock) by the process using it. Released workspaces
+    are moved to .trash and removed by a background reaper thread, which also
+    keeps cached bases and workspaces waiting for removal under max_size bytes:
+    least recently used bases are removed, new workspaces wait for pending
+    removals while over the limit. A workspace is measured once it's released
+    and a base once it's created, the tree is never walked as a whole.
+    Workspaces whose process is gone (crashed runs) are reclaimed by reclaim_stale().
+
+    Checkouts can be copied from cached bases (.base) with reflinks, where
+    the filesystem supports them: the copy is instant and shares the blocks.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        max_size: int,
+        base_ttl: int = 24 * 3600,
+        check_every: int = 60,
+    ):
+        self.root = root
+        self.trash_dir = root / ".trash"
+        self.base_dir = root / ".base"
+        self.max_size = max_size
+        # bases not used for this long are removed
+        self.base_ttl = base_ttl
+        # bases are checked by the reaper this often (seconds)
+        self.check_every = check_every
+        self.size = 0
+        self._reflinks: Optional[bool] = None
+        # open lock files of workspaces held by this process
+        self.locks: Dict[Path, int] = {}
+        self.pid: Optional[int] = None
+
+    def setup(self):
+        """state of the reaper, per process: a forked child doesn't inherit the thread"""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.locks = {}
+        self.changed = threading.Condition()
+        self.pending = 0
+        # sizes of workspaces waiting for removal and of bases, size is their sum
+        self.pending_size = 0
+        self.bases_size = 0
+        self.trash: Queue = Queue()
+        self.reaper = threading.Thread(
+            target=self.reap, name="workspace-reaper", daemon=True
+        )
+        self.reaper.start()
+
+    def acquire(self, package_name: str) -> Path:
+        """create an empty, locked workspace for the package"""
+        self.setup()
+        with self.changed:
+            if self.size > self.max_size and self.pending:
+                logger.info("Workspaces are over their limit, waiting for the reaper.")
+                self.changed.wait_for(lambda: not self.pending)
+        self.root.mkdir(parents=True, exist_ok=True)
+        workspace = Path(tempfile.mkdtemp(prefix=f"{package_name}-", dir=self.root))
+        fd = os.open(str(workspace / LOCK_NAME), os.O_CREAT | os.O_WRONLY, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.locks[workspace] = fd
+        (workspace / "rpms").mkdir()
+        (workspace / "src").mkdir()
+        return workspace
+
+    def release(self, workspace: Path):
+        """hand the workspace over to the reaper, it's no longer usable"""
+        self.setup()
+        fd = self.locks.pop(workspace, None)
+        if fd is None:
+            # released already
+            return
+        self.discard(workspace)
+        os.close(fd)
+
+    def discard(self, path: Path, size: Optional[int] = None):
+        """move the path out of the way (cheap, it's a rename) and queue its removal,
+        it's measured unless its size is known"""
+        if size is None:
+            size = measure_tree(path)["total"]
+        self.trash_dir.mkdir(parents=True, exist_ok=True)
+        target = Path(tempfile.mkdtemp(dir=self.trash_dir))
+        try:
+            os.rename(path, target / path.name)
+        except FileNotFoundError:
+            size = 0
+        self.queue_removal(target, size)
+
+    def queue_removal(self, path: Path, size: int):
+        with self.changed:
+            self.pending += 1
+            self.pending_size += size
+            self.size = self.bases_size + self.pending_size
+        self.trash.put((path, size))
+
+    def reap(self):
+        last_check = 0.0
+        while True:
+            try:
+                path, size = self.trash.get(timeout=self.check_every)
+            except Empty:
+                path = None
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+                with self.changed:
+                    self.pending -= 1
+                    self.pending_size -= size
+                    self.size = self.bases_size + self.pending_size
+                    self.changed.notify_all()
+            if self.trash.empty() and time.monotonic() - last_check >= self.check_every:
+                try:
+                    self.enforce_max_size()
+                except Exception:
+                    logger.exception("Enforcing the size of workspaces failed")
+                last_check = time.monotonic()
+
+    def enforce_max_size(self):
+        """remove expired bases, and the least recently used ones while over max_size"""
+        bases = []
+        for base in self.base_dir.glob("*"):
+            if ".tmp" in base.name:
+                continue
+            size_path = base / SIZE_NAME
+            try:
+                mtime = base.stat().st_mtime
+                if not size_path.is_file():
+                    # created before sizes of bases were recorded
+                    size_path.write_text(str(measure_tree(base / "tree")["total"]))
+                bases.append((mtime, int(size_path.read_text()), base))
+            except (OSError, ValueError):
+                # removed by another process in the meantime
+                continue
+        bases_size = sum(base_size for _, base_size, _ in bases)
+        # without the bases discarded below, they're counted as pending once discarded
+        with self.changed:
+            pending_size = self.pending_size
+        for mtime, base_size, base in sorted(bases):
+            expired = time.time() - mtime > self.base_ttl
+            if not expired and bases_size + pending_size <= self.max_size:
+                break
+            self.discard(base, base_size)
+            bases_size -= base_size
+        with self.changed:
+            self.bases_size = bases_size
+            self.size = self.bases_size + self.pending_size
+            self.changed.notify_all()
+
+    def wait(self):
+        """until all the released workspaces are removed"""
+        self.setup()
+        with self.changed:
+            self.changed.wait_for(lambda: not self.pending)
+
+    def reclaim_stale(self):
+        """queue removal of workspaces left behind by processes which are gone,
+        and of trash the reaper of such a process didn't get to"""
+        self.setup()
+        if not self.root.is_dir():
+            return
+        for path in self.root.iterdir():
+            if path.name.startswith(".") or path in self.locks:
+                continue
+            if self.is_stale(path):
+                logger.info(f"Reclaiming stale workspace {path}")
+                self.discard(path)
+        for path in self.base_dir.glob("*.tmp*"):
+            # bases being created have a lock of their own
+            if self.is_stale(path):
+                self.discard(path)
+        if self.trash_dir.is_dir():
+            for path in self.trash_dir.iterdir():
+                self.queue_removal(path, measure_tree(path)["total"])
+
+    @staticmethod
+    def is_stale(path: Path) -> bool:
+        lock = path / LOCK_NAME
+        if not lock.is_file():
+            # either not a workspace or it's being created, give it a minute
+            return time.time() - path.stat().st_mtime > 60
+        with lock.open() as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+
+    @property
+    def reflinks(self) -> bool:
+        """whether the filesystem of the workspaces can share blocks of copied files"""
+        if self._reflinks is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=self.root, prefix=".probe") as probe:
+                (Path(probe) / "a").write_bytes(b"reflink")
+                self._reflinks = self.copy(Path(probe) / "a", Path(probe) / "b")
+            logger.info(
+                "Workspaces are copied from bases with reflinks."
+                if self._reflinks
+                else "Reflinks are not supported, workspaces are populated from scratch."
+            )
+        return self._reflinks
+
+    @staticmethod
+    def copy(source: Path, target: Path) -> bool:
+        result = subprocess.run(
+            ["cp", "-a", "--reflink=always", str(source), str(target)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if result.returncode:
+            logger.debug(f"Copying {source} with reflinks: {result.stderr}")
+        return result.returncode == 0
+
+    def populate(self, target: Path, key: str, create: Callable[[Path], None]):
+        """
+        Create target by copying the base identified by key, which is created
+        by create(path) first if needed. Without reflinks, a copy is not cheaper
+        than create(target), that's what's done then.
+        """
+        if not self.reflinks:
+            create(target)
+            return
+        base = self.base_dir / sha256(key.encode()).hexdigest()
+        if not base.is_dir():
+            self.setup()
+            self.base_dir.mkdir(parents=True, exist_ok=True)
+            tmp = Path(tempfile.mkdtemp(prefix=f"{base.name}.tmp", dir=self.base_dir))
+            with (tmp / LOCK_NAME).open("w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                create(tmp / "tree")
+                size = measure_tree(tmp / "tree")["total"]
+                (tmp / SIZE_NAME).write_text(str(size))
+                try:
+                    os.rename(tmp, base)
+                except OSError:
+                    # created by someone else in the meantime
+                    self.discard(tmp, size)
+                else:
+                    with self.changed:
+                        self.bases_size += size
+                        self.size = self.bases_size + self.pending_size
+        os.utime(base)
+        if not self.copy(base / "tree", target):
+            # the base is being removed or broken
+            shutil.rmtree(target, ignore_errors=True)
+            create(target)